@@ -1,5 +1,9 @@
 from datetime import datetime, timedelta
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import time
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
@@ -8,7 +12,7 @@ from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 import os
 
-from . import schemas, models, database
+from . import schemas, models, database, cache
 
 # Config
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -26,6 +30,14 @@ if SECRET_KEY == "supersecretkeyCHANGE_ME_IN_PROD":
     import warnings
     warnings.warn("Using default SECRET_KEY! Set SECRET_KEY environment variable in production!")
 
+# Principal cache: who a token belongs to, without a users lookup on every request.
+# Entries are checked against a per-user version in Redis, bumped whenever the
+# user is changed or deleted, and never outlive PRINCIPAL_CACHE_TTL or the token.
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 30))
+principal_cache = cache.LocalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+redis_client = None # Set by main.startup_event
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
@@ -39,6 +51,44 @@ def get_password_hash(password):
         raise ValueError("Password cannot exceed 72 bytes")
     return pwd_context.hash(password)
 
+# bcrypt takes ~100-300 ms per call, so async routes run it on a small dedicated
+# pool instead of the event loop. When the pool and its queue are full the
+# request is rejected with 429 rather than piling up behind other logins.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", 2))
+HASH_QUEUE_MAX = int(os.getenv("HASH_QUEUE_MAX", 32))
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_in_flight = 0
+_hash_rejected = 0
+
+async def _run_hash(fn, *args):
+    global _hash_in_flight, _hash_rejected
+    if _hash_in_flight >= HASH_WORKERS + HASH_QUEUE_MAX:
+        _hash_rejected += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many authentication requests, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    _hash_in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, fn, *args)
+    finally:
+        _hash_in_flight -= 1
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_hash(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_hash(get_password_hash, password)
+
+def hash_pool_stats() -> dict:
+    return {
+        "workers": HASH_WORKERS,
+        "in_flight": _hash_in_flight,
+        "queued": max(0, _hash_in_flight - HASH_WORKERS),
+        "rejected": _hash_rejected,
+    }
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None, user_data: dict = None):
     """
     Create JWT token with optional user metadata
@@ -94,7 +144,81 @@ async def get_current_active_user(current_user: models.User = Depends(get_curren
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-async def get_current_active_superuser(current_user: models.User = Depends(get_current_active_user)):
+class Principal:
+    """Identity of the caller. Enough for most routes, no DB session attached."""
+    __slots__ = ("id", "email", "is_active", "is_superuser")
+
+    def __init__(self, id: int, email: str, is_active: bool, is_superuser: bool):
+        self.id = id
+        self.email = email
+        self.is_active = is_active
+        self.is_superuser = is_superuser
+
+async def get_user_version(user_id: int):
+    if not redis_client:
+        return None
+    try:
+        return await redis_client.get(f"user_ver:{user_id}")
+    except Exception as e:
+        print(f"User version lookup failed: {e}")
+        return None
+
+async def bump_user_version(user_id: int):
+    """Invalidate cached principals of a user (call after changing or deleting them)."""
+    if not redis_client:
+        return
+    try:
+        pipe = redis_client.pipeline()
+        pipe.incr(f"user_ver:{user_id}")
+        pipe.expire(f"user_ver:{user_id}", 86400)
+        await pipe.execute()
+    except Exception as e:
+        print(f"User version bump failed: {e}")
+
+async def get_current_principal(token: str = Depends(oauth2_scheme)):
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    cached = principal_cache.get(key)
+    if cached:
+        principal, version = cached
+        if await get_user_version(principal.id) == version:
+            return principal
+
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email: str = payload.get("sub")
+        if email is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+
+    # Read the version before the user row, so a concurrent change is never cached as current
+    version = await get_user_version(payload["user_id"]) if payload.get("user_id") else None
+
+    async with database.AsyncSessionLocal() as db:
+        result = await db.execute(select(models.User).where(models.User.email == email))
+        user = result.scalars().first()
+    if user is None:
+        raise credentials_exception
+    if not payload.get("user_id"):
+        version = await get_user_version(user.id)
+
+    principal = Principal(user.id, user.email, user.is_active, user.is_superuser)
+    ttl = min(PRINCIPAL_CACHE_TTL, payload.get("exp", 0) - time.time())
+    if ttl > 0:
+        principal_cache.set(key, (principal, version), ttl=ttl)
+    return principal
+
+async def get_current_active_principal(principal: Principal = Depends(get_current_principal)):
+    if not principal.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return principal
+
+async def get_current_active_superuser(current_user: Principal = Depends(get_current_active_principal)):
     if not current_user.is_superuser:
         raise HTTPException(
             status_code=400, detail="The user doesn't have enough privileges"
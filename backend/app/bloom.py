@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import os
+
+from sqlalchemy import select
+
+from . import models, database, cache
+
+# Bloom filter of every short code ever created, stored as a Redis bitmap so all
+# workers share it. "Definitely not there" answers let redirects and slug checks
+# skip Postgres for unknown codes. Deleted codes stay in the filter (that only
+# costs a false positive, i.e. a DB lookup).
+BLOOM_KEY = "bloom:short_codes"
+READY_KEY = "bloom:short_codes:ready"
+LOCK_KEY = "bloom:short_codes:building"
+BLOOM_BITS = int(os.getenv("BLOOM_BITS", 1 << 24)) # 2 MB, ~1% false positives at ~1.7M codes
+BLOOM_HASHES = int(os.getenv("BLOOM_HASHES", 7))
+BUILD_CHUNK = 5000
+BLOOM_CHECK_INTERVAL = int(os.getenv("BLOOM_CHECK_INTERVAL", 60)) # seconds between repair / rebuild checks
+
+# The filter is only trusted if it was built with the current size/hash settings
+_SIGNATURE = f"{BLOOM_BITS}:{BLOOM_HASHES}"
+
+# Codes this worker created whose bits may not have reached Redis. While any
+# are pending the filter is not trusted here, and run_maintenance() re-adds them.
+_failed = set()
+
+
+def positions(code: str):
+    digest = hashlib.blake2b(code.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % BLOOM_BITS for i in range(BLOOM_HASHES)]
+
+
+async def _set_bits(redis_client, codes):
+    pipe = redis_client.pipeline(transaction=False)
+    for code in codes:
+        for pos in positions(code):
+            pipe.setbit(BLOOM_KEY, pos, 1)
+    await pipe.execute()
+
+
+async def add(redis_client, codes):
+    if not redis_client or not codes:
+        return
+    try:
+        await _set_bits(redis_client, codes)
+    except Exception as e:
+        print(f"Bloom filter update failed, disabling it until repaired: {e}")
+        _failed.update(codes)
+        try:
+            # Tell the other workers too (usually fails as well during an outage)
+            await redis_client.delete(READY_KEY)
+        except Exception:
+            pass
+
+
+async def might_contain_many(redis_client, codes) -> dict:
+    """{code: False} only for codes that definitely do not exist. One round trip."""
+    if not redis_client or not codes or _failed:
+        return {code: True for code in codes}
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(READY_KEY)
+        for code in codes:
+            for pos in positions(code):
+                pipe.getbit(BLOOM_KEY, pos)
+        ready, *bits = await pipe.execute()
+    except Exception as e:
+        print(f"Bloom filter lookup failed: {e}")
+        return {code: True for code in codes}
+    if ready != _SIGNATURE:
+        return {code: True for code in codes}
+    return {
+        code: all(bits[i * BLOOM_HASHES:(i + 1) * BLOOM_HASHES])
+        for i, code in enumerate(codes)
+    }
+
+
+async def might_contain(redis_client, code: str) -> bool:
+    """False only if the code definitely does not exist."""
+    return (await might_contain_many(redis_client, [code]))[code]
+
+
+async def rebuild(redis_client):
+    """Load every short code into the filter. Runs in one worker, when missing or stale."""
+    if await redis_client.get(READY_KEY) == _SIGNATURE:
+        return
+    if not await redis_client.set(LOCK_KEY, 1, nx=True, ex=600):
+        return # Another worker is building it
+
+    try:
+        print("Building short code bloom filter...")
+        # Codes created meanwhile are added to the same key by add(), so nothing is missed
+        await redis_client.delete(READY_KEY, BLOOM_KEY)
+        total = 0
+        async with database.AsyncSessionLocal() as db:
+            result = await db.stream(
+                select(models.URL.short_code).execution_options(yield_per=BUILD_CHUNK)
+            )
+            async for codes in result.scalars().partitions():
+                await _set_bits(redis_client, codes)
+                total += len(codes)
+        await redis_client.set(READY_KEY, _SIGNATURE)
+        print(f"Bloom filter ready ({total} codes)")
+    except Exception as e:
+        print(f"Bloom filter build failed: {e}")
+    finally:
+        await redis_client.delete(LOCK_KEY)
+
+
+async def repair(redis_client):
+    """Re-add codes whose earlier add() failed, and drop any "not found" cached for them."""
+    if not _failed:
+        return
+    codes = list(_failed)
+    # Until every worker sees the bits, nobody may trust the filter
+    await redis_client.delete(READY_KEY)
+    await _set_bits(redis_client, codes)
+    await cache.invalidate_links(redis_client, codes)
+    _failed.difference_update(codes)
+    print(f"Bloom filter repaired ({len(codes)} codes re-added)")
+
+
+async def run_maintenance(redis_client):
+    """Background task: repair failed adds and (re)build the filter whenever it is not ready."""
+    while True:
+        try:
+            await repair(redis_client)
+            await rebuild(redis_client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Bloom filter maintenance failed: {e}")
+        await asyncio.sleep(BLOOM_CHECK_INTERVAL)
@@ -0,0 +1,385 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+from datetime import timezone
+
+import redis.asyncio as redis
+
+from . import metrics
+from .database import PoolStats
+
+# In-process (L1) link cache. Each uvicorn worker keeps its own copy in front of
+# Redis (L2) and Postgres, so hot links resolve without any network I/O.
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", 10000))
+LINK_CACHE_TTL = float(os.getenv("LINK_CACHE_TTL", 30))
+
+# Redis (L2) TTL for link records, capped at the link's own expiry
+LINK_REDIS_TTL = int(os.getenv("LINK_REDIS_TTL", 3600))
+# TTLs are shortened by up to this fraction at random so hot keys don't expire together
+LINK_TTL_JITTER = float(os.getenv("LINK_TTL_JITTER", 0.1))
+# After LINK_REDIS_TTL a record is stale: still served for this long while one
+# request refreshes it in the background (stale-while-revalidate)
+LINK_STALE_TTL = int(os.getenv("LINK_STALE_TTL", 300))
+# Cache misses: one loader per code across workers (Redis lock), the rest wait for it
+LINK_LOCK_TTL = float(os.getenv("LINK_LOCK_TTL", 2))
+LINK_LOCK_WAIT = float(os.getenv("LINK_LOCK_WAIT", 1))
+# TTL of the atomic click counters used for links with max_clicks
+CLICK_COUNTER_TTL = int(os.getenv("CLICK_COUNTER_TTL", 86400))
+
+# Negative cache: unknown codes are remembered (L1 + Redis) for this long.
+# Creating a code invalidates its entry, so this only delays nothing real.
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", 60))
+MISSING = {"missing": True}
+
+# Redis pub/sub channel used to tell every worker to drop a short code
+INVALIDATION_CHANNEL = "url_invalidate"
+
+# Atomically count a click against max_clicks.
+# Returns the new count, -1 if the limit is reached, -2 if the counter is missing.
+CLAIM_CLICK_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then return -2 end
+if tonumber(current) >= tonumber(ARGV[1]) then return -1 end
+return redis.call('INCR', KEYS[1])
+"""
+
+# Redis connection pool, per worker. Commands wait up to REDIS_POOL_TIMEOUT for
+# a free connection instead of opening unbounded new ones.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+
+redis_pool_stats = PoolStats()
+
+
+class InstrumentedRedisPool(redis.BlockingConnectionPool):
+    """Blocking pool that records how long each command waited for a connection."""
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            conn = await super().get_connection(*args, **kwargs)
+        except redis.ConnectionError as e:
+            # "No connection available." is raised from the pool wait timing out
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                redis_pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        redis_pool_stats.record(time.perf_counter() - start)
+        return conn
+
+
+def create_redis_client(url: str):
+    pool = InstrumentedRedisPool.from_url(
+        url,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def pool_stats(redis_client) -> dict:
+    if not redis_client:
+        return {}
+    pool = redis_client.connection_pool
+    return {
+        "max_connections": pool.max_connections,
+        "in_use": len(pool._in_use_connections),
+        "idle": len(pool._available_connections),
+        **redis_pool_stats.as_dict(),
+    }
+
+
+class LocalCache:
+    """Bounded LRU cache with a per-entry TTL. Not shared between processes."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+link_cache = LocalCache(LINK_CACHE_SIZE, LINK_CACHE_TTL)
+
+
+def link_record(db_url) -> dict:
+    """Compact, JSON-safe view of a URL row with everything a redirect needs."""
+    expires_at = None
+    if db_url.expires_at:
+        expires_at = db_url.expires_at.replace(tzinfo=timezone.utc).timestamp()
+    return {
+        "url_id": db_url.id,
+        "target": db_url.original_url,
+        "expires_at": expires_at,
+        "max_clicks": db_url.max_clicks or None,
+        "is_active": bool(db_url.is_active),
+        "protected": bool(db_url.password),
+    }
+
+
+def is_expired(record: dict) -> bool:
+    return record["expires_at"] is not None and record["expires_at"] < time.time()
+
+
+def jittered(ttl: float) -> float:
+    return ttl * (1 - LINK_TTL_JITTER * random.random())
+
+
+async def _read_link(redis_client, short_code: str):
+    """(record, refresh_at) from Redis, or (None, None)."""
+    raw = await redis_client.get(f"url:{short_code}")
+    if raw:
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            record = None # Legacy bare-URL value, reload from DB
+        if isinstance(record, dict):
+            return record, record.pop("refresh_at", None)
+    return None, None
+
+
+async def get_link(redis_client, short_code: str, refresh=None):
+    """
+    Look a link record up in L1, then Redis. Returns None on a miss.
+    A stale Redis record is still returned; if `refresh` (see load_link) is
+    given it is reloaded in the background.
+    """
+    record = link_cache.get(short_code)
+    if record is not None:
+        metrics.link_cache_lookups.inc("local", "hit")
+        return record
+    metrics.link_cache_lookups.inc("local", "miss")
+
+    if redis_client:
+        record, refresh_at = await _read_link(redis_client, short_code)
+        if record is not None:
+            if refresh_at is not None and refresh_at < time.time():
+                metrics.link_cache_lookups.inc("redis", "stale")
+                if refresh:
+                    _refresh_in_background(redis_client, short_code, refresh)
+            else:
+                metrics.link_cache_lookups.inc("redis", "hit")
+            link_cache.set(short_code, record, ttl=jittered(LINK_CACHE_TTL))
+            return record
+        metrics.link_cache_lookups.inc("redis", "miss")
+    return None
+
+
+def _queue_link(pipe, short_code: str, record: dict, clicks: int):
+    now = time.time()
+    fresh_for = jittered(LINK_REDIS_TTL)
+    ttl = fresh_for + LINK_STALE_TTL
+    if record["expires_at"] is not None and not is_expired(record):
+        ttl = min(ttl, record["expires_at"] - now)
+
+    payload = dict(record, refresh_at=now + fresh_for)
+    pipe.set(f"url:{short_code}", json.dumps(payload, separators=(",", ":")), ex=max(1, int(ttl)))
+    if record["max_clicks"]:
+        # NX: never roll back a counter other workers have already moved past the DB
+        pipe.set(f"url_clicks:{record['url_id']}", clicks, nx=True, ex=CLICK_COUNTER_TTL)
+
+
+async def store_link(redis_client, short_code: str, record: dict, clicks: int = 0):
+    """Cache a record in L1 and Redis, seeding its click counter if it is limited."""
+    await store_links(redis_client, [(short_code, record, clicks)])
+
+
+async def store_links(redis_client, links):
+    """store_link for many (short_code, record, clicks) in one round trip."""
+    for short_code, record, _ in links:
+        link_cache.set(short_code, record, ttl=jittered(LINK_CACHE_TTL))
+    if not redis_client or not links:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for short_code, record, clicks in links:
+        _queue_link(pipe, short_code, record, clicks)
+    await pipe.execute()
+
+
+# short_code -> task, for loads / refreshes running in this worker
+_loading = {}
+_refreshing = {}
+
+
+def _single_flight(tasks: dict, short_code: str, factory):
+    task = tasks.get(short_code)
+    if task is None:
+        task = tasks[short_code] = asyncio.ensure_future(factory())
+        task.add_done_callback(lambda _: tasks.pop(short_code, None))
+    return task
+
+
+async def _store_loaded(redis_client, short_code: str, loaded):
+    if loaded is None:
+        await store_missing(redis_client, short_code)
+        return None
+    record, clicks = loaded
+    await store_link(redis_client, short_code, record, clicks)
+    return record
+
+
+async def _load(redis_client, short_code: str, fetch):
+    lock_key = f"lock:url:{short_code}"
+    locked = False
+    if redis_client:
+        locked = await redis_client.set(lock_key, 1, nx=True, px=int(LINK_LOCK_TTL * 1000))
+        if not locked:
+            # Another worker is loading this code: wait for its result instead of querying too
+            deadline = time.monotonic() + LINK_LOCK_WAIT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+                record, _ = await _read_link(redis_client, short_code)
+                if record is not None and record.get("missing"):
+                    # The other loader found no such code (negative cache entry)
+                    link_cache.set(short_code, MISSING, ttl=min(LINK_CACHE_TTL, NEGATIVE_CACHE_TTL))
+                    return None
+                if record is not None:
+                    link_cache.set(short_code, record, ttl=jittered(LINK_CACHE_TTL))
+                    return record
+            # The other loader is slow or died; load it ourselves
+
+    try:
+        return await _store_loaded(redis_client, short_code, await fetch(short_code))
+    finally:
+        if locked:
+            await redis_client.delete(lock_key)
+
+
+async def load_link(redis_client, short_code: str, fetch):
+    """
+    Cache miss: fetch(short_code) -> (record, clicks) or None, then cache the result.
+    Returns the link record, or None if the code does not exist.
+    Concurrent misses for a code share one fetch per worker and, via a short
+    Redis lock, usually one across workers.
+    """
+    task = _single_flight(_loading, short_code, lambda: _load(redis_client, short_code, fetch))
+    # Shielded: one disconnecting client must not cancel the load for the others
+    return await asyncio.shield(task)
+
+
+async def _refresh(redis_client, short_code: str, fetch):
+    lock_key = f"lock:url:{short_code}"
+    try:
+        if not await redis_client.set(lock_key, 1, nx=True, px=int(LINK_LOCK_TTL * 1000)):
+            return # Another worker is already refreshing it
+        try:
+            await _store_loaded(redis_client, short_code, await fetch(short_code))
+        finally:
+            await redis_client.delete(lock_key)
+    except Exception as e:
+        print(f"Link refresh failed for {short_code}: {e}")
+
+
+def _refresh_in_background(redis_client, short_code: str, fetch):
+    _single_flight(_refreshing, short_code, lambda: _refresh(redis_client, short_code, fetch))
+
+
+async def store_missing(redis_client, short_code: str):
+    """Remember that a short code does not exist."""
+    link_cache.set(short_code, MISSING, ttl=min(LINK_CACHE_TTL, NEGATIVE_CACHE_TTL))
+    if redis_client:
+        await redis_client.set(f"url:{short_code}", json.dumps(MISSING), ex=NEGATIVE_CACHE_TTL)
+
+
+async def seed_click_counter(redis_client, url_id: int, clicks: int):
+    if not redis_client:
+        return
+    try:
+        await redis_client.set(f"url_clicks:{url_id}", clicks, nx=True, ex=CLICK_COUNTER_TTL)
+    except Exception as e:
+        print(f"Click counter unavailable: {e}")
+
+
+async def claim_click(redis_client, url_id: int, max_clicks: int):
+    """
+    Count one click against max_clicks atomically across workers.
+    Returns True/False, or None when Redis or the counter is unavailable.
+    """
+    if not redis_client:
+        return None
+    try:
+        claim = redis_client.register_script(CLAIM_CLICK_SCRIPT) # EVALSHA, loads on first use
+        result = await claim(keys=[f"url_clicks:{url_id}"], args=[max_clicks])
+    except Exception as e:
+        print(f"Click counter unavailable: {e}")
+        return None
+    if result == -2:
+        return None
+    return result != -1
+
+
+async def invalidate_link(redis_client, short_code: str):
+    """Drop a short code from this worker's L1 cache, Redis and every other worker."""
+    link_cache.pop(short_code)
+    if redis_client:
+        await redis_client.delete(f"url:{short_code}")
+        await redis_client.publish(INVALIDATION_CHANNEL, short_code)
+
+
+async def invalidate_links(redis_client, short_codes):
+    """invalidate_link for many codes in one round trip (e.g. freshly created ones)."""
+    for short_code in short_codes:
+        link_cache.pop(short_code)
+    if redis_client and short_codes:
+        pipe = redis_client.pipeline(transaction=False)
+        for short_code in short_codes:
+            pipe.delete(f"url:{short_code}")
+            pipe.publish(INVALIDATION_CHANNEL, short_code)
+        await pipe.execute()
+
+
+async def listen_for_invalidations(redis_client):
+    """Background task: evict short codes announced on the invalidation channel."""
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Anything published while we were disconnected is lost, so start clean
+            link_cache.clear()
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    link_cache.pop(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Cache invalidation listener error: {e}")
+            link_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
@@ -0,0 +1,171 @@
+import asyncio
+import os
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import Integer, column, insert, update, values
+
+from . import models, database, rollups, enrichment, counters, dimensions
+
+# Click ingestion: redirects append to an in-memory buffer and return at once.
+# A background flusher writes the buffer in batches. Clicks still in the
+# buffer are lost if the worker is killed without a graceful shutdown.
+CLICK_BATCH_SIZE = int(os.getenv("CLICK_BATCH_SIZE", 500))
+CLICK_FLUSH_INTERVAL = float(os.getenv("CLICK_FLUSH_INTERVAL", 1.0))
+CLICK_BUFFER_MAX = int(os.getenv("CLICK_BUFFER_MAX", 100000))
+
+
+class ClickBuffer:
+    """Collects clicks in memory and writes them to Postgres in batches."""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_size: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._clicks = []  # [(row, client_ip), ...]
+        self._pending = Counter()  # url_id -> clicks not yet applied to urls.clicks
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+        self.redis_client = None
+
+    def add(self, url_id: int, referrer: str, user_agent: str, client_ip: str):
+        row = {
+            "url_id": url_id,
+            "timestamp": datetime.utcnow(),
+            "referrer": dimensions.referrer_host(referrer),
+            "user_agent": user_agent, # Raw, for enrichment only (not stored)
+        }
+        self._clicks.append((row, client_ip))
+        self._pending[url_id] += 1
+
+        if len(self._clicks) > self.max_size:
+            dropped, _ = self._clicks.pop(0)
+            self._forget(dropped["url_id"], 1)
+            print("Click buffer full, dropping oldest click")
+
+        if self._wakeup and len(self._clicks) >= self.batch_size:
+            self._wakeup.set()
+
+    def pending(self, url_id: int) -> int:
+        """Clicks buffered in this worker that are not yet reflected in urls.clicks."""
+        return self._pending.get(url_id, 0)
+
+    def __len__(self):
+        return len(self._clicks)
+
+    def _forget(self, url_id: int, count: int):
+        self._pending[url_id] -= count
+        if self._pending[url_id] <= 0:
+            del self._pending[url_id]
+
+    def _requeue(self, batch):
+        # Put a failed batch back in front, keeping the buffer bounded
+        self._clicks = batch + self._clicks
+        overflow = len(self._clicks) - self.max_size
+        if overflow > 0:
+            for row, _ in self._clicks[:overflow]:
+                self._forget(row["url_id"], 1)
+            del self._clicks[:overflow]
+
+    async def flush(self) -> bool:
+        """Write up to one batch. Returns False if the write failed."""
+        async with self._lock:
+            if not self._clicks:
+                return True
+            batch, self._clicks = self._clicks[:self.batch_size], self._clicks[self.batch_size:]
+            deltas = Counter(row["url_id"] for row, _ in batch)
+
+            try:
+                # Referrer labels -> dictionary ids (cached; new labels are committed first)
+                referrer_ids = await dimensions.resolve({("referrer", row["referrer"]) for row, _ in batch})
+
+                async with database.AsyncSessionLocal() as db:
+                    # 1. Apply aggregated click deltas in one UPDATE ... FROM (VALUES ...)
+                    #    RETURNING tells us which links still exist (others were deleted)
+                    v = values(
+                        column("id", Integer), column("delta", Integer), name="deltas"
+                    ).data(list(deltas.items()))
+                    res = await db.execute(
+                        update(models.URL)
+                        .where(models.URL.id == v.c.id)
+                        .values(clicks=models.URL.clicks + v.c.delta)
+                        .returning(models.URL.id, models.URL.user_id)
+                        .execution_options(synchronize_session=False)
+                    )
+                    owners = dict(res.all())
+                    batch_live = [(row, ip) for row, ip in batch if row["url_id"] in owners]
+
+                    # 2. Bulk insert the click events (referrer as a dictionary id)
+                    click_ids = []
+                    if batch_live:
+                        res = await db.execute(
+                            insert(models.ClickEvent.__table__).returning(
+                                models.ClickEvent.id, sort_by_parameter_order=True
+                            ),
+                            [
+                                {
+                                    "url_id": row["url_id"],
+                                    "timestamp": row["timestamp"],
+                                    "referrer_id": referrer_ids[("referrer", row["referrer"])],
+                                }
+                                for row, _ in batch_live
+                            ],
+                        )
+                        click_ids = res.scalars().all()
+
+                    # 3. Hourly / daily / referrer rollups
+                    await rollups.add_clicks(db, [row for row, _ in batch_live], owners)
+                    await db.commit()
+            except asyncio.CancelledError:
+                self._requeue(batch)
+                raise
+            except Exception as e:
+                print(f"Click flush failed, will retry: {e}")
+                self._requeue(batch)
+                return False
+
+            for url_id, count in deltas.items():
+                self._forget(url_id, count)
+            await counters.incr(self.redis_client, clicks=len(batch_live))
+
+            # 4. Async Enrichment (batched by the enrichment worker)
+            for click_id, (row, client_ip) in zip(click_ids, batch_live):
+                enrichment.worker.submit(
+                    click_id, row["user_agent"], client_ip,
+                    row["url_id"], owners[row["url_id"]], row["timestamp"]
+                )
+            return True
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Keep going straight away while a full batch is waiting
+            if await self.flush() and len(self._clicks) >= self.batch_size:
+                self._wakeup.set()
+
+    def start(self, redis_client=None):
+        self.redis_client = redis_client
+        # Event/Lock are created here so they bind to the running loop
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flusher and drain whatever is still buffered."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._lock:
+            while self._clicks:
+                if not await self.flush():
+                    print(f"Click buffer drain failed, {len(self._clicks)} clicks lost")
+                    break
+
+
+click_buffer = ClickBuffer(CLICK_BATCH_SIZE, CLICK_FLUSH_INTERVAL, CLICK_BUFFER_MAX)
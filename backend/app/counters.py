@@ -0,0 +1,82 @@
+from sqlalchemy import func, select
+
+from . import models, database
+
+# Global totals for /admin/stats, kept in one Redis hash and adjusted as users,
+# links and clicks are created or deleted. reconcile() recounts from Postgres.
+STATS_KEY = "stats:global"
+FIELDS = ("users", "urls", "clicks")
+
+_reconciling = False
+
+# Apply deltas only if the hash exists. On a missing hash (first deploy, Redis
+# restart) HINCRBY would create fields holding just the deltas, and get() would
+# then serve those instead of triggering a recount.
+INCR_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+for i = 1, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+
+async def incr(redis_client, **deltas):
+    """e.g. incr(redis_client, urls=1). Failures are logged, never raised."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not redis_client or not deltas:
+        return
+    args = []
+    for field, delta in deltas.items():
+        args += [field, int(delta)]
+    try:
+        script = redis_client.register_script(INCR_IF_EXISTS_SCRIPT)
+        await script(keys=[STATS_KEY], args=args)
+    except Exception as e:
+        print(f"Stats counter update failed: {e}")
+
+
+async def get(redis_client):
+    """Current totals, or None if the counters have not been initialised or Redis is down."""
+    if not redis_client:
+        return None
+    try:
+        values = await redis_client.hmget(STATS_KEY, *FIELDS)
+    except Exception as e:
+        print(f"Stats counter read failed: {e}")
+        return None
+    if any(v is None for v in values):
+        return None
+    return {field: max(int(v), 0) for field, v in zip(FIELDS, values)}
+
+
+async def reconcile(redis_client) -> dict:
+    """Recount everything from Postgres and overwrite the counters."""
+    global _reconciling
+    _reconciling = True
+    try:
+        async with database.AsyncSessionLocal() as db:
+            totals = {
+                "users": (await db.execute(select(func.count(models.User.id)))).scalar() or 0,
+                "urls": (await db.execute(select(func.count(models.URL.id)))).scalar() or 0,
+                # Not count(click_events): old click partitions may have been dropped (retention)
+                "clicks": (await db.execute(select(func.sum(models.URL.clicks)))).scalar() or 0,
+            }
+        if redis_client:
+            try:
+                await redis_client.hset(STATS_KEY, mapping=totals)
+            except Exception as e:
+                # Still answer from Postgres; the next call recounts again
+                print(f"Stats counter seed failed: {e}")
+        return totals
+    finally:
+        _reconciling = False
+
+
+async def reconcile_in_background(redis_client):
+    if _reconciling:
+        return
+    try:
+        await reconcile(redis_client)
+    except Exception as e:
+        print(f"Stats reconcile failed: {e}")
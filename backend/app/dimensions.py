@@ -0,0 +1,56 @@
+import os
+from urllib.parse import urlsplit
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from . import models, database, cache
+
+# Dictionary encoding for click dimensions. click_events stores small integer
+# ids; the labels live once in click_dimension_values. Ids never change, so each
+# worker caches (kind, value) -> id and only asks Postgres about new labels.
+DIMENSION_CACHE_SIZE = int(os.getenv("DIMENSION_CACHE_SIZE", 50000))
+
+Values = models.ClickDimensionValue.__table__
+
+_ids = cache.LocalCache(DIMENSION_CACHE_SIZE, ttl=float("inf"))
+
+
+def referrer_host(referrer: str) -> str:
+    """Referrers are interned by host: full URLs would make every label unique."""
+    if not referrer or referrer.startswith("Direct"):
+        return referrer or "Direct"
+    try:
+        host = urlsplit(referrer).hostname
+    except ValueError:
+        return "Other" # Malformed header (e.g. "http://[abc"); never fail the redirect over it
+    return host or "Other"
+
+
+async def resolve(pairs) -> dict:
+    """{(kind, value): id} for the given pairs, creating any that are new."""
+    ids, missing = {}, set()
+    for pair in pairs:
+        dim_id = _ids.get(pair)
+        if dim_id is None:
+            missing.add(pair)
+        else:
+            ids[pair] = dim_id
+    if not missing:
+        return ids
+
+    # Own transaction, committed before any click references the new ids
+    async with database.AsyncSessionLocal() as db:
+        rows = [{"kind": kind, "value": value} for kind, value in sorted(missing)]
+        await db.execute(pg_insert(Values).values(rows).on_conflict_do_nothing(index_elements=["kind", "value"]))
+        res = await db.execute(
+            select(Values.c.kind, Values.c.value, Values.c.id)
+            .where(tuple_(Values.c.kind, Values.c.value).in_(sorted(missing)))
+        )
+        found = res.all()
+        await db.commit()
+
+    for kind, value, dim_id in found:
+        _ids.set((kind, value), dim_id)
+        ids[(kind, value)] = dim_id
+    return ids
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+
+from sqlalchemy import DateTime, Integer, column, update, values
+from user_agents import parse
+
+from . import models, database, rollups, geoip, metrics, dimensions
+
+# Click enrichment: a single asyncio worker per process pulls freshly inserted
+# clicks off a queue in batches, parses user agents / resolves countries, and
+# writes everything back with one bulk UPDATE per batch.
+ENRICH_BATCH_SIZE = int(os.getenv("ENRICH_BATCH_SIZE", 500))
+ENRICH_QUEUE_MAX = int(os.getenv("ENRICH_QUEUE_MAX", 100000))
+UA_CACHE_SIZE = int(os.getenv("UA_CACHE_SIZE", 10000))
+
+# Common bots/crawlers/HTTP clients, matched before the (regex-heavy) full parse
+KNOWN_BOTS = {
+    "googlebot": "Googlebot",
+    "bingbot": "Bingbot",
+    "yandexbot": "YandexBot",
+    "baiduspider": "Baiduspider",
+    "duckduckbot": "DuckDuckBot",
+    "applebot": "Applebot",
+    "facebookexternalhit": "Facebook",
+    "twitterbot": "Twitterbot",
+    "linkedinbot": "LinkedInBot",
+    "slackbot": "Slackbot",
+    "discordbot": "Discordbot",
+    "telegrambot": "TelegramBot",
+    "whatsapp": "WhatsApp",
+    "curl/": "curl",
+    "wget/": "Wget",
+    "python-requests": "python-requests",
+    "go-http-client": "Go-http-client",
+}
+BOT_PATTERN = re.compile("|".join(re.escape(token) for token in KNOWN_BOTS), re.IGNORECASE)
+
+
+@lru_cache(maxsize=UA_CACHE_SIZE)
+def device_label(user_agent_str: str) -> str:
+    """Device label ("Browser on OS") for a raw User-Agent header. Memoized per UA string."""
+    bot = BOT_PATTERN.search(user_agent_str)
+    if bot:
+        return f"{KNOWN_BOTS[bot.group(0).lower()]} (Bot)"
+    ua = parse(user_agent_str)
+    return f"{ua.browser.family} on {ua.os.family}"
+
+
+def ua_cache_stats() -> dict:
+    info = device_label.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
+
+class EnrichmentWorker:
+    def __init__(self, batch_size: int, queue_max: int):
+        self.batch_size = batch_size
+        self.queue_max = queue_max
+        self._queue = None
+        self._task = None
+
+    def submit(self, click_id: int, user_agent: str, client_ip: str, url_id: int, user_id: int, timestamp):
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait((click_id, user_agent, client_ip, url_id, user_id, timestamp))
+        except asyncio.QueueFull:
+            print("Enrichment queue full, click left unprocessed")
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def process(self, batch):
+        # Both lookups are memoized, so each distinct UA / IP is resolved once
+        rows = []
+        for click_id, user_agent, client_ip, _, _, timestamp in batch:
+            start = time.perf_counter()
+            device = device_label(user_agent)
+            parsed = time.perf_counter()
+            country = geoip.resolve_country(client_ip)
+            metrics.enrichment_latency.observe(parsed - start, "user_agent")
+            metrics.enrichment_latency.observe(time.perf_counter() - parsed, "geoip")
+            rows.append((click_id, timestamp, device, country))
+
+        # Labels -> dictionary ids (cached; only new labels touch Postgres)
+        ids = await dimensions.resolve(
+            {("device", device) for *_, device, _ in rows} | {("country", country) for *_, country in rows}
+        )
+
+        async with database.AsyncSessionLocal() as db:
+            # 1. One UPDATE ... FROM (VALUES ...) for the whole batch. The timestamp
+            # (part of the key) and its range let Postgres skip the other partitions.
+            v = values(
+                column("id", Integer), column("timestamp", DateTime),
+                column("device_id", Integer), column("country_id", Integer), name="enriched"
+            ).data([
+                (click_id, timestamp, ids[("device", device)], ids[("country", country)])
+                for click_id, timestamp, device, country in rows
+            ])
+            timestamps = [timestamp for _, timestamp, _, _ in rows]
+            res = await db.execute(
+                update(models.ClickEvent)
+                .where(
+                    models.ClickEvent.id == v.c.id,
+                    models.ClickEvent.timestamp == v.c.timestamp,
+                    models.ClickEvent.timestamp.between(min(timestamps), max(timestamps)),
+                )
+                .values(device_id=v.c.device_id, country_id=v.c.country_id)
+                .returning(models.ClickEvent.id)
+                .execution_options(synchronize_session=False)
+            )
+            updated = set(res.scalars().all()) # Clicks of deleted links are gone
+
+            # 2. Device / country rollups
+            counts, owners = Counter(), {}
+            for (click_id, _, _, url_id, user_id, timestamp), (*_, device, country) in zip(batch, rows):
+                if click_id not in updated:
+                    continue
+                counts[(url_id, timestamp.date(), "device", device)] += 1
+                counts[(url_id, timestamp.date(), "country", country)] += 1
+                owners[url_id] = user_id
+            await rollups.add_dimensions(db, counts, owners)
+            await db.commit()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self.process(batch)
+            except Exception as e:
+                print(f"Click enrichment failed for {len(batch)} clicks: {e}")
+
+    def start(self):
+        # Queue is created here so it binds to the running loop
+        self._queue = asyncio.Queue(maxsize=self.queue_max)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker and process whatever is still queued."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._queue and not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self.process(batch)
+            except Exception as e:
+                print(f"Click enrichment failed for {len(batch)} clicks: {e}")
+
+
+worker = EnrichmentWorker(ENRICH_BATCH_SIZE, ENRICH_QUEUE_MAX)
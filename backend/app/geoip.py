@@ -0,0 +1,119 @@
+import bisect
+import csv
+import ipaddress
+import os
+from functools import lru_cache
+
+# Local GeoIP: country lookups come from a database file loaded once per worker,
+# never from the network. Supported files:
+#   *.mmdb - MaxMind / DB-IP GeoLite2-Country style database (memory-mapped)
+#   *.csv  - IP range table: start,end,...,country (dotted or integer addresses),
+#            e.g. DB-IP "IP to Country Lite" or IP2Location LITE DB1
+GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH", "")
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", 65536))
+
+DEV_COUNTRY = "Indonesia (Dev)" # Treat all private/local IPs as Dev Country
+UNKNOWN_COUNTRY = "Unknown"
+
+
+class CountryResolver:
+    """Maps an IP address to a country name. Returns None when not found."""
+
+    def lookup(self, ip):
+        return None
+
+
+class MMDBResolver(CountryResolver):
+    def __init__(self, path: str):
+        import maxminddb
+        self._reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def lookup(self, ip):
+        record = self._reader.get(ip)
+        if not record:
+            return None
+        country = record.get("country") or record.get("registered_country") or {}
+        names = country.get("names") or {}
+        return names.get("en") or country.get("iso_code")
+
+
+class RangeTableResolver(CountryResolver):
+    """Sorted, non-overlapping IP ranges searched with bisect."""
+
+    def __init__(self, path: str):
+        # One table per IP version, since IPv4 and IPv6 integers overlap
+        self._tables = {4: ([], [], []), 6: ([], [], [])}
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                try:
+                    start, end = self._parse(row[0]), self._parse(row[1])
+                except ValueError:
+                    continue # Header or malformed line
+                if start.version != end.version:
+                    continue
+                starts, ends, countries = self._tables[start.version]
+                starts.append(int(start))
+                ends.append(int(end))
+                countries.append(row[-1].strip() or None)
+
+        for version, (starts, ends, countries) in self._tables.items():
+            if any(a > b for a, b in zip(starts, starts[1:])):
+                rows = sorted(zip(starts, ends, countries))
+                self._tables[version] = tuple(list(col) for col in zip(*rows))
+
+    @staticmethod
+    def _parse(value: str):
+        value = value.strip()
+        if value.isdigit():
+            number = int(value)
+            return ipaddress.ip_address(number) if number <= 0xFFFFFFFF else ipaddress.IPv6Address(number)
+        return ipaddress.ip_address(value)
+
+    def lookup(self, ip):
+        starts, ends, countries = self._tables[ip.version]
+        i = bisect.bisect_right(starts, int(ip)) - 1
+        if i >= 0 and int(ip) <= ends[i]:
+            return countries[i]
+        return None
+
+
+resolver = CountryResolver()
+
+
+def load(path: str = GEOIP_DB_PATH):
+    """Load the GeoIP database. Called once at startup."""
+    global resolver
+    if not path:
+        print("GEOIP_DB_PATH not set, countries will be recorded as Unknown")
+        return
+    try:
+        if path.endswith(".mmdb"):
+            resolver = MMDBResolver(path)
+        else:
+            resolver = RangeTableResolver(path)
+        resolve_country.cache_clear()
+        print(f"GeoIP database loaded: {path}")
+    except Exception as e:
+        print(f"GeoIP database failed to load ({path}): {e}")
+
+
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def resolve_country(client_ip: str) -> str:
+    if client_ip == "localhost":
+        return DEV_COUNTRY
+    try:
+        ip = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return UNKNOWN_COUNTRY
+
+    # Docker internal / LAN / loopback addresses
+    if ip.is_private or ip.is_loopback or ip.is_link_local:
+        return DEV_COUNTRY
+
+    try:
+        return resolver.lookup(ip) or UNKNOWN_COUNTRY
+    except Exception as e:
+        print(f"GeoIP Failed: {e}")
+        return UNKNOWN_COUNTRY
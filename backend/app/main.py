@@ -1,19 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Header
-from typing import List
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, Header, BackgroundTasks
+from typing import List, Optional
 from fastapi.responses import RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import func, desc, update, delete
+from sqlalchemy import func, desc, delete, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from fastapi.middleware.cors import CORSMiddleware
-import string
-import random
 import re
 from datetime import datetime, timedelta
 import os
-import redis.asyncio as redis
+import json
+import asyncio
+import time
+import secrets
 
-from . import models, schemas, database, auth
+from . import models, schemas, database, auth, cache, clicks, rollups, geoip, enrichment, shortcodes, counters, pagination, ratelimit, bloom, metrics, warmup, partitions
 
 app = FastAPI()
 
@@ -29,21 +31,54 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.CURSOR_HEADER],
 )
 
+# Metrics: latency and SQL statements per route (see metrics.py)
+metrics.instrument_engine(database.engine)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    token = metrics.start_request()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Route template (e.g. /{short_code}), not the raw path, to keep label cardinality bounded
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.http_requests.inc(request.method, route, status_code)
+        metrics.http_latency.observe(time.perf_counter() - start, request.method, route)
+        metrics.finish_request(token, route)
+
 # Redis Config
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 redis_client = None
+background_jobs = []
 
 @app.on_event("startup")
 async def startup_event():
     # 1. Initialize Redis
     global redis_client
-    redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+    redis_client = cache.create_redis_client(REDIS_URL)
+    auth.redis_client = redis_client
+    ratelimit.redis_client = redis_client
+    background_jobs.append(asyncio.create_task(cache.listen_for_invalidations(redis_client)))
+    geoip.load()
     
     # 2. Create Tables (Async)
     async with database.engine.begin() as conn:
+        # Workers starting together would race on CREATE TABLE / the partition conversion
+        await partitions.lock(conn)
         await conn.run_sync(models.Base.metadata.create_all)
+        # Monthly click_events partitions (converts a pre-partitioning table once)
+        await partitions.setup(conn)
+        # create_all skips existing tables, so add indexes introduced since then
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
         
     # 3. Seed Admin User
     async with database.AsyncSessionLocal() as db:
@@ -63,9 +98,34 @@ async def startup_event():
             db.add(new_admin)
             await db.commit()
 
+    # 4. Backfill click rollups (first run after upgrade only), before any clicks are flushed
+    async with database.AsyncSessionLocal() as db:
+        await rollups.backfill(db)
+    clicks.click_buffer.start(redis_client)
+    enrichment.worker.start()
+    
+    # 5. Short code bloom filter: built once tables exist, then kept repaired
+    background_jobs.append(asyncio.create_task(bloom.run_maintenance(redis_client)))
+    
+    # 6. Preload the hottest links into the cache (background, time-boxed)
+    background_jobs.append(asyncio.create_task(warmup.warm(redis_client)))
+    
+    # 7. Premake click partitions / apply retention (periodically)
+    background_jobs.append(asyncio.create_task(partitions.run_maintenance()))
+
 @app.on_event("shutdown")
 async def shutdown_event():
     global redis_client
+    for job in background_jobs:
+        job.cancel()
+    await asyncio.gather(*background_jobs, return_exceptions=True)
+    background_jobs.clear()
+
+    # Drain buffered clicks (then their enrichment) before the worker exits
+    await clicks.click_buffer.stop()
+    await enrichment.worker.stop()
+    auth.hash_executor.shutdown(wait=False)
+
     if redis_client:
         await redis_client.close()
 
@@ -77,7 +137,7 @@ async def register(user: schemas.UserCreate, db: AsyncSession = Depends(database
     if result.scalars().first():
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = auth.get_password_hash(user.password)
+    hashed_password = await auth.get_password_hash_async(user.password)
     db_user = models.User(
         email=user.email, 
         hashed_password=hashed_password,
@@ -86,14 +146,15 @@ async def register(user: schemas.UserCreate, db: AsyncSession = Depends(database
     db.add(db_user)
     await db.commit()
     await db.refresh(db_user)
+    await counters.incr(redis_client, users=1)
     return db_user
 
-@app.post("/auth/token", response_model=schemas.Token)
+@app.post("/auth/token", response_model=schemas.Token, dependencies=[Depends(ratelimit.limit("token"))])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_db)):
     result = await db.execute(select(models.User).where(models.User.email == form_data.username))
     user = result.scalars().first()
     
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+    if not user or not await auth.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -200,9 +261,10 @@ async def reset_password(
         raise HTTPException(404, "User not found")
         
     # 3. Update Password
-    user.hashed_password = auth.get_password_hash(data.new_password)
+    user.hashed_password = await auth.get_password_hash_async(data.new_password)
     db.add(user)
     await db.commit()
+    await auth.bump_user_version(user.id)
     
     # 4. Delete Token
     await redis_client.delete(f"pwd_reset:{data.token}")
@@ -213,37 +275,107 @@ async def reset_password(
 
 @app.get("/admin/users", response_model=List[schemas.User], dependencies=[Depends(auth.get_current_active_superuser)])
 async def read_users(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(database.get_db)
 ):
-    result = await db.execute(select(models.User).offset(skip).limit(limit))
-    return result.scalars().all()
+    # Keyset pagination when a cursor is given; skip is kept for old clients
+    query = pagination.keyset(select(models.User), models.User.created_at, models.User.id, cursor, limit)
+    if not cursor:
+        query = query.offset(skip)
+    users = (await db.execute(query)).scalars().all()
+    pagination.set_next_cursor(response, users, limit)
+    return users
 
 @app.get("/admin/stats", response_model=schemas.GlobalStats, dependencies=[Depends(auth.get_current_active_superuser)])
-async def read_global_stats(db: AsyncSession = Depends(database.get_db)):
-    # Total Users
-    user_count_query = select(func.count(models.User.id))
-    user_count_res = await db.execute(user_count_query)
-    total_users = user_count_res.scalar()
-
-    # Total URLs
-    url_count_query = select(func.count(models.URL.id))
-    url_count_res = await db.execute(url_count_query)
-    total_urls = url_count_res.scalar()
-
-    # Total Clicks
-    click_count_query = select(func.count(models.ClickEvent.id))
-    click_count_res = await db.execute(click_count_query)
-    total_clicks = click_count_res.scalar()
+async def read_global_stats(background_tasks: BackgroundTasks, exact: bool = False):
+    # Served from maintained counters (see counters.py), no table scans
+    totals = await counters.get(redis_client)
+    if totals is None:
+        # First call (or Redis flushed): count once and seed the counters
+        totals = await counters.reconcile(redis_client)
+    elif exact:
+        # Recount in the background; later calls see the reconciled numbers
+        background_tasks.add_task(counters.reconcile_in_background, redis_client)
     
     return schemas.GlobalStats(
-        total_users=total_users or 0, 
-        total_urls=total_urls or 0, 
-        total_clicks=total_clicks or 0
+        total_users=totals["users"], 
+        total_urls=totals["urls"], 
+        total_clicks=totals["clicks"]
     )
 
 
+@app.get("/admin/pools", dependencies=[Depends(auth.get_current_active_superuser)])
+async def read_pool_stats():
+    # Per worker: checked-out connections, checkout wait times and timeouts
+    return {
+        "postgres": database.pool_stats(),
+        "redis": cache.pool_stats(redis_client),
+        "password_hashing": auth.hash_pool_stats(),
+    }
+
+
+@app.post("/admin/cache/warm", dependencies=[Depends(auth.get_current_active_superuser)])
+async def warm_link_cache(background_tasks: BackgroundTasks, top_n: int = warmup.WARMUP_TOP_N):
+    # e.g. after a Redis flush; progress is logged by the worker doing it
+    background_tasks.add_task(warmup.warm, redis_client, top_n, force=True)
+    return {"message": f"Warming up to {top_n} links"}
+
+@metrics.collector("shawty_background_queue_depth", "Items waiting in background queues", ("queue",))
+def _queue_depths():
+    return {("enrichment",): enrichment.worker.qsize(), ("click_buffer",): len(clicks.click_buffer)}
+
+@metrics.collector("shawty_lookup_cache_entries", "Entries in per-worker lookup caches", ("cache",))
+def _cache_sizes():
+    return {
+        ("links",): len(cache.link_cache),
+        ("user_agent",): enrichment.ua_cache_stats()["size"],
+        ("geoip",): geoip.resolve_country.cache_info().currsize,
+    }
+
+@metrics.collector("shawty_lookup_cache_requests_total", "Hits / misses of per-worker memoized lookups", ("cache", "result"), kind="counter")
+def _cache_hits():
+    ua = enrichment.ua_cache_stats()
+    country = geoip.resolve_country.cache_info()
+    return {
+        ("user_agent", "hit"): ua["hits"], ("user_agent", "miss"): ua["misses"],
+        ("geoip", "hit"): country.hits, ("geoip", "miss"): country.misses,
+    }
+
+@metrics.collector("shawty_pool_connections", "Connection pool usage", ("pool", "state"))
+def _pool_connections():
+    db_pool = database.pool_stats()
+    redis_pool = cache.pool_stats(redis_client)
+    values = {("postgres", "checked_out"): db_pool["checked_out"], ("postgres", "idle"): db_pool["idle"]}
+    if redis_pool:
+        values[("redis", "checked_out")] = redis_pool["in_use"]
+        values[("redis", "idle")] = redis_pool["idle"]
+    values[("password_hashing", "checked_out")] = auth.hash_pool_stats()["in_flight"]
+    return values
+
+@metrics.collector("shawty_pool_checkout_events_total", "Connection checkouts, timeouts and total wait seconds", ("pool", "kind"), kind="counter")
+def _pool_checkouts():
+    values = {}
+    for name, stats in (("postgres", database.db_pool_stats), ("redis", cache.redis_pool_stats)):
+        values[(name, "checkouts")] = stats.checkouts
+        values[(name, "timeouts")] = stats.timeouts
+        values[(name, "wait_seconds")] = round(stats.wait_total, 6)
+    values[("password_hashing", "timeouts")] = auth.hash_pool_stats()["rejected"]
+    return values
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics(authorization: Optional[str] = Header(None)):
+    # Prometheus text format for this worker. Disabled unless METRICS_TOKEN is set:
+    # nginx forwards unknown paths to the backend, so it would otherwise be public
+    if not metrics.METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not secrets.compare_digest(authorization or "", f"Bearer {metrics.METRICS_TOKEN}"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/admin/users", response_model=schemas.User, dependencies=[Depends(auth.get_current_active_superuser)])
 async def create_user_admin(
     user_in: schemas.UserCreateAdmin, 
@@ -254,7 +386,7 @@ async def create_user_admin(
     if result.scalars().first():
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = auth.get_password_hash(user_in.password)
+    hashed_password = await auth.get_password_hash_async(user_in.password)
     db_user = models.User(
         email=user_in.email, 
         hashed_password=hashed_password,
@@ -265,6 +397,7 @@ async def create_user_admin(
     db.add(db_user)
     await db.commit()
     await db.refresh(db_user)
+    await counters.incr(redis_client, users=1)
     return db_user
 
 @app.patch("/admin/users/{user_id}", response_model=schemas.User, dependencies=[Depends(auth.get_current_active_superuser)])
@@ -282,7 +415,7 @@ async def update_user_admin(
     update_data = user_in.dict(exclude_unset=True)
     
     if "password" in update_data and update_data["password"]:
-        hashed_password = auth.get_password_hash(update_data["password"])
+        hashed_password = await auth.get_password_hash_async(update_data["password"])
         update_data["hashed_password"] = hashed_password
         del update_data["password"]
     
@@ -292,6 +425,7 @@ async def update_user_admin(
     db.add(db_user)
     await db.commit()
     await db.refresh(db_user)
+    await auth.bump_user_version(db_user.id)
     return db_user
 
 @app.delete("/admin/users/{user_id}", status_code=204, dependencies=[Depends(auth.get_current_active_superuser)])
@@ -304,30 +438,65 @@ async def delete_user_admin(
     
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
+    
+    # Totals removed along with the user's links (for the global counters)
+    url_count, url_clicks = (await db.execute(
+        select(func.count(models.URL.id), func.sum(models.URL.clicks)).where(models.URL.user_id == user_id)
+    )).one()
         
     await db.delete(db_user)
     await db.commit()
+    await auth.bump_user_version(user_id)
+    await counters.incr(redis_client, users=-1, urls=-url_count, clicks=-(url_clicks or 0))
     return None
 
 import csv
 import io
+import zlib
+from fastapi import Query
 from fastapi.responses import StreamingResponse
 
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", 2000))
+
 @app.get("/admin/reports/csv", dependencies=[Depends(auth.get_current_active_superuser)])
-async def get_admin_csv_report(db: AsyncSession = Depends(database.get_db)):
-    # Query all URLs joined with User
+async def get_admin_csv_report(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    owner: Optional[str] = None,
+    active_only: bool = False,
+    gzip_output: bool = Query(False, alias="gzip")
+):
+    # Plain columns (no ORM entities), filtered in SQL
     stmt = (
-        select(models.URL, models.User.email, models.User.full_name)
+        select(
+            models.URL.created_at,
+            models.User.email,
+            models.User.full_name,
+            models.URL.short_code,
+            models.URL.original_url,
+            models.URL.clicks,
+            models.URL.is_active
+        )
         .join(models.User, models.URL.user_id == models.User.id)
         .order_by(desc(models.URL.created_at))
     )
-    result = await db.execute(stmt)
-    rows = result.all() # [(URL, email, full_name), ...]
+    if start: stmt = stmt.where(models.URL.created_at >= start)
+    if end: stmt = stmt.where(models.URL.created_at < end)
+    if owner: stmt = stmt.where(models.User.email == owner)
+    if active_only: stmt = stmt.where(models.URL.is_active == True)
 
-    # Create CSV Stream
-    def iter_csv():
+    # Create CSV Stream: server-side cursor, fetched and written CSV_CHUNK_ROWS at a time.
+    # The generator owns its session, since the request's session is closed before streaming.
+    async def iter_csv():
         output = io.StringIO()
         writer = csv.writer(output)
+        compressor = zlib.compressobj(wbits=31) if gzip_output else None # 31 = gzip container
+
+        def emit():
+            data = output.getvalue().encode("utf-8")
+            output.seek(0)
+            output.truncate(0)
+            return compressor.compress(data) if compressor else data
         
         # Header
         writer.writerow([
@@ -339,29 +508,37 @@ async def get_admin_csv_report(db: AsyncSession = Depends(database.get_db)):
             "Clicks", 
             "Status"
         ])
-        yield output.getvalue()
-        output.seek(0)
-        output.truncate(0)
-
-        for row in rows:
-            url_obj, email, full_name = row
-            writer.writerow([
-                url_obj.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                email,
-                full_name or "N/A",
-                url_obj.short_code,
-                url_obj.original_url,
-                url_obj.clicks,
-                "Active" if url_obj.is_active else "Inactive"
-            ])
-            yield output.getvalue()
-            output.seek(0)
-            output.truncate(0)
+        yield emit()
 
+        async with database.AsyncSessionLocal() as db:
+            result = await db.stream(stmt.execution_options(yield_per=CSV_CHUNK_ROWS))
+            async for rows in result.partitions():
+                writer.writerows(
+                    [
+                        created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                        email,
+                        full_name or "N/A",
+                        short_code,
+                        original_url,
+                        clicks,
+                        "Active" if is_active else "Inactive"
+                    ]
+                    for created_at, email, full_name, short_code, original_url, clicks, is_active in rows
+                )
+                chunk = emit()
+                if chunk: yield chunk
+
+        if compressor:
+            yield compressor.flush()
+
+    filename = f"shawty_report_{datetime.now().strftime('%Y%m%d')}.csv"
+    if gzip_output:
+        filename += ".gz"
     headers = {
-        "Content-Disposition": f"attachment; filename=shawty_report_{datetime.now().strftime('%Y%m%d')}.csv"
+        "Content-Disposition": f"attachment; filename={filename}"
     }
-    return StreamingResponse(iter_csv(), media_type="text/csv", headers=headers)
+    media_type = "application/gzip" if gzip_output else "text/csv"
+    return StreamingResponse(iter_csv(), media_type=media_type, headers=headers)
 
 
 
@@ -377,7 +554,7 @@ async def update_user(
 ):
     # Verify password if changing sensitive info like email or password
     if user_in.current_password:
-        if not auth.verify_password(user_in.current_password, current_user.hashed_password):
+        if not await auth.verify_password_async(user_in.current_password, current_user.hashed_password):
             raise HTTPException(status_code=400, detail="Incorrect current password")
     elif user_in.password:
         # If trying to set new password without current pass confirmation
@@ -397,11 +574,12 @@ async def update_user(
         current_user.bio = user_in.bio
         
     if user_in.password:
-        current_user.hashed_password = auth.get_password_hash(user_in.password)
+        current_user.hashed_password = await auth.get_password_hash_async(user_in.password)
         
     db.add(current_user)
     await db.commit()
     await db.refresh(current_user)
+    await auth.bump_user_version(current_user.id)
     return current_user
 
 @app.delete("/users/me", status_code=204)
@@ -411,18 +589,21 @@ async def delete_user_me(
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
     # 1. Verify Password
-    if not auth.verify_password(user_confirm.password, current_user.hashed_password):
+    if not await auth.verify_password_async(user_confirm.password, current_user.hashed_password):
         raise HTTPException(status_code=403, detail="Invalid password")
     
     # 2. Delete User's URLs (Clicks cascade from URL)
     # Using bulk delete for efficiency
-    await db.execute(delete(models.URL).where(models.URL.user_id == current_user.id))
+    deleted = await db.execute(delete(models.URL).where(models.URL.user_id == current_user.id).returning(models.URL.clicks))
+    deleted_clicks = [c or 0 for c in deleted.scalars().all()]
     
     # 3. Delete User
     await db.execute(delete(models.User).where(models.User.id == current_user.id))
     
     # 4. Commit
     await db.commit()
+    await auth.bump_user_version(current_user.id)
+    await counters.incr(redis_client, users=-1, urls=-len(deleted_clicks), clicks=-sum(deleted_clicks))
     
     return None
 
@@ -432,67 +613,62 @@ async def delete_user_me(
 async def get_user_analytics(
     time_range: str = "7d", 
     db: AsyncSession = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: auth.Principal = Depends(auth.get_current_active_principal)
 ):
     days = 7
     if time_range == "24h": days = 1
     elif time_range == "30d": days = 30
     elif time_range == "90d": days = 90
     
-    start_date = datetime.utcnow() - timedelta(days=days)
-    
-    # 1. Get User's URLs IDs
-    user_urls_res = await db.execute(select(models.URL.id).where(models.URL.user_id == current_user.id))
-    user_url_ids = user_urls_res.scalars().all()
-    
-    if not user_url_ids:
-        # No links, no stats
-        return {
-            "chart_data": [],
-            "top_referrers": [],
-            "top_devices": [],
-            "top_countries": [],
-            "top_links": [],
-            "total_clicks": 0,
-            "avg_ctr": 0
-        }
-    
-    # 2. Chart Data (Total Clicks over time)
-    # Filter ClickEvents where url_id in user_url_ids AND timestamp >= start_date
-    # Note: Postgres uses to_char. SQLite uses strftime.
-    # Production uses Postgres, so we use to_char.
-    date_col = func.to_char(models.ClickEvent.timestamp, 'YYYY-MM-DD')
-    # Note: SQLite uses %Y-%m-%d. For Postgres use to_char. Assuming SQLite for now based on context.
-    
-    q_chart = (
-        select(date_col, func.count(models.ClickEvent.id))
-        .where(models.ClickEvent.url_id.in_(user_url_ids))
-        .where(models.ClickEvent.timestamp >= start_date)
-        .group_by(date_col)
-        .order_by(date_col)
-    )
+    start_day = (datetime.utcnow() - timedelta(days=days)).date()
     
-    chart_res = await db.execute(q_chart)
-    chart_rows = chart_res.all()
-    chart_dict = {r[0]: r[1] for r in chart_rows}
+    # All queries read the pre-aggregated rollups (see rollups.py), never raw click_events
     
+    # 1. Chart Data (Total Clicks over time)
+    now = datetime.utcnow()
     chart_data = []
-    # Fill gaps
-    for i in range(days + 1):
-        if time_range == "24h":
-            # Hourly granularity not implemented for brevity, sticking to daily or fallback
-            pass 
-        d = (datetime.utcnow() - timedelta(days=days - i)).strftime("%Y-%m-%d")
-        chart_data.append({"date": d, "clicks": chart_dict.get(d, 0)})
+    if time_range == "24h":
+        # Hourly buckets, straight from the hourly rollup
+        hourly = models.ClickRollupHourly
+        start_hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+        q_chart = (
+            select(hourly.bucket, func.sum(hourly.clicks))
+            .where(hourly.user_id == current_user.id)
+            .where(hourly.bucket >= start_hour)
+            .group_by(hourly.bucket)
+        )
+        chart_dict = {r[0]: r[1] for r in (await db.execute(q_chart)).all()}
+        
+        # Fill gaps
+        for i in range(24):
+            h = start_hour + timedelta(hours=i)
+            chart_data.append({"date": h.strftime("%Y-%m-%dT%H:00:00Z"), "clicks": chart_dict.get(h, 0)})
+    else:
+        daily = models.ClickRollupDaily
+        q_chart = (
+            select(daily.day, func.sum(daily.clicks))
+            .where(daily.user_id == current_user.id)
+            .where(daily.day >= start_day)
+            .group_by(daily.day)
+        )
+        chart_dict = {r[0]: r[1] for r in (await db.execute(q_chart)).all()}
+        
+        # Fill gaps
+        for i in range(days + 1):
+            d = (now - timedelta(days=days - i)).date()
+            chart_data.append({"date": d.strftime("%Y-%m-%d"), "clicks": chart_dict.get(d, 0)})
 
     # Helper for Top Lists
-    async def get_top(col, limit=5):
+    dim = models.ClickRollupDimension
+    async def get_top(dimension, limit=5):
+        total = func.sum(dim.clicks)
         q = (
-            select(col, func.count(models.ClickEvent.id))
-            .where(models.ClickEvent.url_id.in_(user_url_ids))
-            .where(models.ClickEvent.timestamp >= start_date)
-            .group_by(col)
-            .order_by(desc(func.count(models.ClickEvent.id)))
+            select(dim.value, total)
+            .where(dim.user_id == current_user.id)
+            .where(dim.dimension == dimension)
+            .where(dim.day >= start_day)
+            .group_by(dim.value)
+            .order_by(desc(total))
             .limit(limit)
         )
         res = await db.execute(q)
@@ -500,113 +676,215 @@ async def get_user_analytics(
 
     return {
         "chart_data": chart_data,
-        "top_referrers": await get_top(models.ClickEvent.referrer),
-        "top_devices": await get_top(models.ClickEvent.user_agent),
-        "top_countries": await get_top(models.ClickEvent.country),
+        "top_referrers": await get_top("referrer"),
+        "top_devices": await get_top("device"),
+        "top_countries": await get_top("country"),
         "top_links": (await db.execute(select(models.URL).where(models.URL.user_id == current_user.id).order_by(desc(models.URL.clicks)).limit(5))).scalars().all()
     }
 
 
 # --- URL Routes ---
 
-def generate_short_code(length=6):
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
-
 @app.post("/shorten_auth", response_model=schemas.URL)
 async def create_short_url_auth(
     url_in: schemas.URLCreate, 
     db: AsyncSession = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_principal)
 ):
     return await create_short_url_impl(url_in, db, current_user.id)
 
-@app.post("/shorten", response_model=schemas.URL)
+# Rate Limiting for Guests (see ratelimit.POLICIES)
+@app.post("/shorten", response_model=schemas.URL, dependencies=[Depends(ratelimit.limit("shorten"))])
 async def create_short_url_public(
     url_in: schemas.URLCreate, 
-    request: Request,
     db: AsyncSession = Depends(database.get_db)
 ):
-    # Rate Limiting for Guests
-    client_ip = request.client.host
-    rate_limit_key = f"rate_limit:{client_ip}"
-    
-    if redis_client:
-        current_count = await redis_client.get(rate_limit_key)
-        if current_count and int(current_count) >= 5:
-             raise HTTPException(status_code=429, detail="Rate limit exceeded. Please Sign Up for unlimited links.")
-        
-        # Increment and set expire if new
-        pipe = redis_client.pipeline()
-        pipe.incr(rate_limit_key)
-        if not current_count:
-            pipe.expire(rate_limit_key, 2592000) # 30 Days (1 Month)
-        await pipe.execute()
-
     # Public endpoint - no user tracking
     return await create_short_url_impl(url_in, db, None)
 
-from typing import Optional
+# Reserved words
+RESERVED_WORDS = {'admin', 'verify', 'login', 'dashboard', 'api', 'auth', 'check', 'unlock', 'shorten', 'analytics', 'settings', 'register', 'links', 'metrics'}
+ALIAS_PATTERN = re.compile(r'^[a-zA-Z0-9-_]+$')
+
+def alias_error(alias: str) -> Optional[str]:
+    """Validation error for a custom alias, or None if it is acceptable."""
+    if not ALIAS_PATTERN.match(alias):
+        return "Alias alphanumeric only"
+    if alias.lower() in RESERVED_WORDS:
+        return "Reserved alias"
+    return None
+
+async def register_new_codes(short_codes):
+    # Add to the bloom filter and drop any cached "not found" entries
+    await bloom.add(redis_client, short_codes)
+    await cache.invalidate_links(redis_client, short_codes)
 
 async def create_short_url_impl(url_in: schemas.URLCreate, db: AsyncSession, user_id: Optional[int]):
-    # Reserved words
-    RESERVED_WORDS = {'admin', 'verify', 'login', 'dashboard', 'api', 'auth', 'check', 'unlock', 'shorten', 'analytics', 'settings', 'register', 'links'}
-    
     if url_in.custom_alias:
-        if not re.match(r'^[a-zA-Z0-9-_]+$', url_in.custom_alias):
-            raise HTTPException(status_code=400, detail="Alias alphanumeric only")
-        if url_in.custom_alias.lower() in RESERVED_WORDS:
-            raise HTTPException(status_code=400, detail="Reserved alias")
-        
-        # Uniqueness
-        res = await db.execute(select(models.URL).where(models.URL.short_code == url_in.custom_alias))
-        if res.scalars().first():
-             raise HTTPException(status_code=400, detail="Alias taken")
+        error = alias_error(url_in.custom_alias)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
         short_code = url_in.custom_alias
     else:
-        short_code = generate_short_code()
-        while True:
-            res = await db.execute(select(models.URL).where(models.URL.short_code == short_code))
-            if not res.scalars().first(): break
-            short_code = generate_short_code()
-
-    db_url = models.URL(
-        original_url=url_in.original_url,
-        short_code=short_code,
-        password=url_in.password,
-        expires_at=url_in.expires_at,
-        max_clicks=url_in.max_clicks,
-        user_id=user_id
-    )
-    db.add(db_url)
+        # Pre-allocated, collision-free code (see shortcodes.py)
+        short_code = await shortcodes.allocator.allocate(db)
+
+    # Uniqueness is enforced by the insert itself (ON CONFLICT), not a prior SELECT
+    while True:
+        stmt = (
+            pg_insert(models.URL)
+            .values(
+                original_url=url_in.original_url,
+                short_code=short_code,
+                password=url_in.password,
+                expires_at=url_in.expires_at,
+                max_clicks=url_in.max_clicks,
+                user_id=user_id
+            )
+            .on_conflict_do_nothing(index_elements=[models.URL.short_code])
+            .returning(models.URL)
+        )
+        db_url = (await db.execute(stmt)).scalars().first()
+        if db_url: break
+        
+        if url_in.custom_alias:
+            raise HTTPException(status_code=400, detail="Alias taken")
+        # Generated code already used as a custom alias / legacy code: take the next one
+        short_code = await shortcodes.allocator.allocate(db)
+
     await db.commit()
-    await db.refresh(db_url)
+    await counters.incr(redis_client, urls=1)
+    await register_new_codes([db_url.short_code])
     return db_url
 
+BULK_SHORTEN_MAX = int(os.getenv("BULK_SHORTEN_MAX", 10000))
+
+@app.post("/shorten_auth/bulk", response_model=List[schemas.BulkShortenResult], dependencies=[Depends(ratelimit.limit("bulk"))])
+async def create_short_urls_bulk(
+    request: Request,
+    db: AsyncSession = Depends(database.get_db),
+    current_user: auth.Principal = Depends(auth.get_current_principal)
+):
+    """
+    Create many links in one request. Body is a JSON array of URLCreate objects,
+    or NDJSON (one object per line) with Content-Type: application/x-ndjson.
+    Returns one result per item, in input order, with either the link or an error.
+    """
+    # 1. Parse items (a bad item is reported, it does not fail the batch)
+    body = await request.body()
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            raw_items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            raw_items = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(raw_items, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array or NDJSON")
+    if len(raw_items) > BULK_SHORTEN_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_SHORTEN_MAX} links per request")
+
+    results = [schemas.BulkShortenResult(index=i) for i in range(len(raw_items))]
+    items = {} # index -> URLCreate
+    for i, raw in enumerate(raw_items):
+        try:
+            items[i] = schemas.URLCreate.model_validate(raw)
+        except ValidationError as e:
+            err = e.errors()[0]
+            field = ".".join(str(p) for p in err["loc"])
+            results[i].error = f"{field}: {err['msg']}" if field else err["msg"]
+
+    # 2. Aliases: format, reserved words, duplicates in the batch, then one query for taken ones
+    aliases = {}
+    for i, item in list(items.items()):
+        if not item.custom_alias: continue
+        error = alias_error(item.custom_alias)
+        if not error and item.custom_alias in aliases:
+            error = "Alias duplicated in batch"
+        if error:
+            results[i].error = error
+            del items[i]
+        else:
+            aliases[item.custom_alias] = i
+
+    if aliases:
+        taken = (await db.execute(select(models.URL.short_code).where(models.URL.short_code.in_(list(aliases))))).scalars().all()
+        for alias in taken:
+            results[aliases[alias]].error = "Alias taken"
+            del items[aliases[alias]]
+
+    # 3. Codes for everything else, allocated in one block. A generated code must not
+    # equal an alias in this batch: ON CONFLICT would drop one row and both items would match the other
+    codes = {}
+    pending = [i for i, item in items.items() if not item.custom_alias]
+    while pending:
+        for i, code in zip(pending, await shortcodes.allocator.allocate_many(db, len(pending))):
+            codes[i] = code
+        pending = [i for i in pending if codes[i] in aliases]
+    for alias, i in aliases.items():
+        if i in items: codes[i] = alias
+
+    # 4. Multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING; retry generated codes that collided
+    while items:
+        rows = [
+            {
+                "original_url": item.original_url,
+                "short_code": codes[i],
+                "password": item.password,
+                "expires_at": item.expires_at,
+                "max_clicks": item.max_clicks,
+                "user_id": current_user.id
+            }
+            for i, item in items.items()
+        ]
+        stmt = pg_insert(models.URL).on_conflict_do_nothing(index_elements=[models.URL.short_code]).returning(models.URL)
+        created = {u.short_code: u for u in (await db.execute(stmt, rows)).scalars().all()}
+        
+        retry = []
+        for i, item in list(items.items()):
+            if codes[i] in created:
+                results[i].url = schemas.URL.model_validate(created[codes[i]])
+                del items[i]
+            elif item.custom_alias:
+                results[i].error = "Alias taken"
+                del items[i]
+            else:
+                retry.append(i)
+        for i, code in zip(retry, await shortcodes.allocator.allocate_many(db, len(retry))):
+            codes[i] = code
+
+    await db.commit()
+    await counters.incr(redis_client, urls=sum(1 for r in results if r.url))
+    await register_new_codes([r.url.short_code for r in results if r.url])
+    return results
+
 # --- User URL Management Routes ---
 
 @app.get("/urls", response_model=list[schemas.URL])
 async def get_user_urls(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: auth.Principal = Depends(auth.get_current_active_principal)
 ):
-    query = (
-        select(models.URL)
-        .where(models.URL.user_id == current_user.id)
-        .order_by(desc(models.URL.created_at))
-        .offset(skip)
-        .limit(limit)
+    # Keyset pagination on (created_at, id), served by ix_urls_user_created_id
+    query = pagination.keyset(
+        select(models.URL).where(models.URL.user_id == current_user.id),
+        models.URL.created_at, models.URL.id, cursor, limit
     )
-    res = await db.execute(query)
-    return res.scalars().all()
+    if not cursor:
+        query = query.offset(skip)
+    urls = (await db.execute(query)).scalars().all()
+    pagination.set_next_cursor(response, urls, limit)
+    return urls
 
 @app.delete("/urls/{short_code}")
 async def delete_user_url(
     short_code: str,
     db: AsyncSession = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: auth.Principal = Depends(auth.get_current_active_principal)
 ):
     # Check ownership
     res = await db.execute(select(models.URL).where(models.URL.short_code == short_code, models.URL.user_id == current_user.id))
@@ -617,10 +895,10 @@ async def delete_user_url(
         
     await db.delete(db_url)
     await db.commit()
+    await counters.incr(redis_client, urls=-1, clicks=-(db_url.clicks or 0))
     
-    # Invalidate Cache
-    if redis_client:
-        await redis_client.delete(f"url:{short_code}")
+    # Invalidate Cache (Redis + every worker's L1)
+    await cache.invalidate_link(redis_client, short_code)
         
     return {"message": "URL deleted successfully"}
 
@@ -629,7 +907,7 @@ async def update_user_url(
     short_code: str,
     url_update: schemas.URLUpdate,
     db: AsyncSession = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: auth.Principal = Depends(auth.get_current_active_principal)
 ):
     res = await db.execute(select(models.URL).where(models.URL.short_code == short_code, models.URL.user_id == current_user.id))
     db_url = res.scalars().first()
@@ -639,14 +917,9 @@ async def update_user_url(
         
     if url_update.original_url:
         db_url.original_url = url_update.original_url
-        # Update Cache
-        if redis_client:
-            await redis_client.set(f"url:{short_code}", url_update.original_url, ex=3600)
             
     if url_update.is_active is not None:
         db_url.is_active = url_update.is_active
-        if not url_update.is_active and redis_client:
-             await redis_client.delete(f"url:{short_code}")
              
     if url_update.max_clicks and url_update.max_clicks > 0:
         db_url.max_clicks = url_update.max_clicks
@@ -654,121 +927,101 @@ async def update_user_url(
     db.add(db_url)
     await db.commit()
     await db.refresh(db_url)
-    return db_url
 
-from fastapi import BackgroundTasks
-import httpx
-from user_agents import parse
+    # Invalidate Cache (Redis + every worker's L1); next redirect reloads from DB
+    await cache.invalidate_link(redis_client, short_code)
+    return db_url
 
-# Helper to extract real client IP behind proxy
-def get_client_ip(request: Request) -> str:
-    x_forwarded_for = request.headers.get("x-forwarded-for")
-    if x_forwarded_for:
-        # X-Forwarded-For can be a comma-separated list, first one is the client
-        return x_forwarded_for.split(",")[0].strip()
-    return request.headers.get("x-real-ip") or request.client.host
+async def claim_click(record: dict, db: Optional[AsyncSession] = None) -> bool:
+    """Count one click against max_clicks. Redis is the authority, Postgres the fallback."""
+    if not record["max_clicks"]:
+        return True
+    
+    allowed = await cache.claim_click(redis_client, record["url_id"], record["max_clicks"])
+    if allowed is not None:
+        return allowed
+    
+    # Counter expired or Redis is down: recount from Postgres + this worker's buffer
+    query = select(models.URL.clicks).where(models.URL.id == record["url_id"])
+    if db is not None:
+        stored = (await db.execute(query)).scalar()
+    else:
+        async with database.AsyncSessionLocal() as session:
+            stored = (await session.execute(query)).scalar()
+    current = (stored or 0) + clicks.click_buffer.pending(record["url_id"])
+    if current >= record["max_clicks"]:
+        return False
+    
+    await cache.seed_click_counter(redis_client, record["url_id"], current)
+    allowed = await cache.claim_click(redis_client, record["url_id"], record["max_clicks"])
+    return True if allowed is None else allowed
 
-# Background Task for Enriching Analytics
-async def process_click_stats(click_id: int, user_agent_str: str, client_ip: str):
+async def fetch_link(short_code: str):
+    """Cache miss: read the link from Postgres. Returns (record, clicks) or None."""
     async with database.AsyncSessionLocal() as db:
-        # 1. Parse User Agent
-        ua = parse(user_agent_str)
-        device = f"{ua.browser.family} on {ua.os.family}"
-        
-        # 2. GeoIP Lookup
-        country = "Unknown"
-        
-        # Filter Local/Private IPs
-        # Docker internal IPs usually start with 172. or 10. or 192.168.
-        is_private = client_ip.startswith(("127.", "::1", "10.", "172.", "192.168."))
-        
-        if is_private or client_ip == "localhost":
-            country = "Indonesia (Dev)" # Treat all private/local IPs as Dev Country
-        else:
-            try:
-                # Use public IP-API (free, limit 45 req/min)
-                async with httpx.AsyncClient() as client:
-                    resp = await client.get(f"http://ip-api.com/json/{client_ip}", timeout=3.0)
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        if data.get("status") == "success":
-                            country = data.get("country", "Unknown")
-                            
-            except Exception as e:
-                print(f"GeoIP Failed: {e}")
+        res = await db.execute(select(models.URL).where(models.URL.short_code == short_code))
+        db_url = res.scalars().first()
+    
+    if not db_url:
+        return None
+    return cache.link_record(db_url), db_url.clicks + clicks.click_buffer.pending(db_url.id)
 
-        # 3. Update ClickEvent
-        await db.execute(
-            update(models.ClickEvent)
-            .where(models.ClickEvent.id == click_id)
-            .values(user_agent=device, country=country)
-        )
-        await db.commit()
+# Read once; the redirect path should not touch os.environ per request
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
 @app.get("/{short_code}")
-async def redirect_to_url(
-    short_code: str, 
-    request: Request,
-    background_tasks: BackgroundTasks,
-    db: AsyncSession = Depends(database.get_db),
-    user_agent: str = Header("Unknown")
-):
-    if redis_client:
-        cached = await redis_client.get(f"url:{short_code}")
-        if cached: return RedirectResponse(cached)
-
-    res = await db.execute(select(models.URL).where(models.URL.short_code == short_code))
-    db_url = res.scalars().first()
+async def redirect_to_url(short_code: str, request: Request):
+    # Hot path: no session or header dependencies. A DB session is only opened
+    # on a cache miss (fetch_link) or a max_clicks recount (claim_click).
     
-    if not db_url: raise HTTPException(404, detail="URL not found")
+    # L1 (in-process) then L2 (Redis): no DB query on a hit; stale records are refreshed in the background
+    record = await cache.get_link(redis_client, short_code, refresh=fetch_link)
     
-    if not db_url.is_active: raise HTTPException(410, "Inactive")
+    # Negative cache / bloom filter: unknown codes never reach Postgres
+    if record is not None and record.get("missing"):
+        raise HTTPException(404, detail="URL not found")
+    if record is None and not await bloom.might_contain(redis_client, short_code):
+        await cache.store_missing(redis_client, short_code)
+        raise HTTPException(404, detail="URL not found")
+
+    if record is None:
+        # Single-flight: concurrent misses for this code share one query
+        record = await cache.load_link(redis_client, short_code, fetch_link)
+        if record is None or record.get("missing"):
+            raise HTTPException(404, detail="URL not found")
     
-    # Check expiration
-    if db_url.expires_at:
-        from datetime import datetime
-        if db_url.expires_at < datetime.utcnow():
-            raise HTTPException(410, "Link expired")
+    if not record["is_active"]: raise HTTPException(410, "Inactive")
     
-    # Check max clicks
-    if db_url.max_clicks and db_url.clicks >= db_url.max_clicks:
-        raise HTTPException(410, "Maximum clicks reached")
+    # Check expiration
+    if cache.is_expired(record):
+        raise HTTPException(410, "Link expired")
     
-    if db_url.password:
+    if record["protected"]:
         # Redirect to frontend unlock page
         # Using a special prefix or just relying on frontend routing. 
         # Since we use HashRouter or BrowserRouter, simple 307 redirect might change method.
         # Let's return 307 to frontend /unlock path
-        frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
-        return RedirectResponse(f"{frontend_url}/unlock/{short_code}")
+        return RedirectResponse(f"{FRONTEND_URL}/unlock/{short_code}")
     
-    # Initial Log (Fast)
-    click = models.ClickEvent(
-        url_id=db_url.id, 
+    # Check max clicks (atomic across workers)
+    if not await claim_click(record):
+        raise HTTPException(410, "Maximum clicks reached")
+    
+    # Buffered Log (flushed + enriched in the background)
+    clicks.click_buffer.add(
+        url_id=record["url_id"], 
         referrer=request.headers.get("referer") or "Direct", 
-        user_agent=user_agent, # Raw first
-        country="Processing..." # Placeholder
+        user_agent=request.headers.get("user-agent", "Unknown"),
+        client_ip=ratelimit.get_client_ip(request)
     )
-    db.add(click)
-    await db.execute(update(models.URL).where(models.URL.id == db_url.id).values(clicks=models.URL.clicks + 1))
-    await db.commit()
-    await db.refresh(click) # Get ID
-    
-    # Async Enrichment
-    client_ip = get_client_ip(request)
-    background_tasks.add_task(process_click_stats, click.id, user_agent, client_ip)
-    
-    
-    if redis_client: await redis_client.set(f"url:{short_code}", db_url.original_url, ex=3600)
     
-    return RedirectResponse(db_url.original_url)
+    return RedirectResponse(record["target"])
 
-@app.post("/unlock/{short_code}")
+@app.post("/unlock/{short_code}", dependencies=[Depends(ratelimit.limit("unlock"))])
 async def unlock_url(
     short_code: str,
     unlock: schemas.UnlockRequest,
     request: Request,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(database.get_db),
     user_agent: str = Header("Unknown")
 ):
@@ -778,45 +1031,80 @@ async def unlock_url(
     if not db_url or not db_url.is_active:
         raise HTTPException(404, "Link not found")
     
-    # Check expiration
-    if db_url.expires_at:
-        from datetime import datetime
-        if db_url.expires_at < datetime.utcnow():
-            raise HTTPException(410, "Link expired")
+    record = cache.link_record(db_url)
     
-    # Check max clicks
-    if db_url.max_clicks and db_url.clicks >= db_url.max_clicks:
-        raise HTTPException(410, "Maximum clicks reached")
+    # Check expiration
+    if cache.is_expired(record):
+        raise HTTPException(410, "Link expired")
         
     if db_url.password and db_url.password != unlock.password:
         raise HTTPException(403, "Incorrect password")
+    
+    # Check max clicks (atomic across workers)
+    if not await claim_click(record, db):
+        raise HTTPException(410, "Maximum clicks reached")
         
     # Log Click (Authenticated by password)
-    click = models.ClickEvent(
+    clicks.click_buffer.add(
         url_id=db_url.id, 
         referrer=request.headers.get("referer") or "Direct (Password)", 
         user_agent=user_agent, 
-        country="Processing..."
+        client_ip=ratelimit.get_client_ip(request)
     )
-    db.add(click)
-    await db.execute(update(models.URL).where(models.URL.id == db_url.id).values(clicks=models.URL.clicks + 1))
-    await db.commit()
-    await db.refresh(click)
-    
-    # Async Enrichment
-    client_ip = get_client_ip(request)
-    background_tasks.add_task(process_click_stats, click.id, user_agent, client_ip)
     
     return {"original_url": db_url.original_url}
 
-@app.get("/check/{slug}")
+@app.get("/check/{slug}", dependencies=[Depends(ratelimit.limit("check"))])
 async def check_slug(slug: str, db: AsyncSession = Depends(database.get_db)):
-    res = await db.execute(select(models.URL).where(models.URL.short_code == slug))
-    return {"available": not res.scalars().first()}
+    # Same rules as create_short_url_impl, so "available" means it can be created
+    error = alias_error(slug)
+    if error:
+        return {"available": False, "reason": error}
+    
+    # Cached or filtered out: answer without the DB
+    record = await cache.get_link(redis_client, slug)
+    if record is not None:
+        return {"available": bool(record.get("missing"))}
+    if not await bloom.might_contain(redis_client, slug):
+        return {"available": True}
+    
+    # EXISTS only, no ORM entity
+    taken = (await db.execute(select(exists().where(models.URL.short_code == slug)))).scalar()
+    return {"available": not taken}
+
+CHECK_BATCH_MAX = int(os.getenv("CHECK_BATCH_MAX", 100))
+
+@app.post("/check", response_model=List[schemas.SlugAvailability], dependencies=[Depends(ratelimit.limit("check"))])
+async def check_slugs(body: schemas.SlugCheckRequest, db: AsyncSession = Depends(database.get_db)):
+    """Check many candidate aliases at once (e.g. for alias suggestions)."""
+    if len(body.slugs) > CHECK_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CHECK_BATCH_MAX} slugs per request")
+    
+    results = {}
+    candidates = []
+    for slug in dict.fromkeys(body.slugs):
+        error = alias_error(slug)
+        if error:
+            results[slug] = schemas.SlugAvailability(slug=slug, available=False, reason=error)
+        else:
+            candidates.append(slug)
+    
+    # 1. Bloom filter (one round trip), 2. one IN query for whatever might exist
+    maybe = await bloom.might_contain_many(redis_client, candidates)
+    to_query = [slug for slug in candidates if maybe[slug]]
+    taken = set()
+    if to_query:
+        taken = set((await db.execute(select(models.URL.short_code).where(models.URL.short_code.in_(to_query)))).scalars().all())
+    for slug in candidates:
+        results[slug] = schemas.SlugAvailability(
+            slug=slug, available=slug not in taken, reason="Alias taken" if slug in taken else None
+        )
+    
+    return [results[slug] for slug in body.slugs]
 
 # Legacy /dashboard/stats for compatibility (or refactor frontend to use new endpoint)
 @app.get("/dashboard/stats")
-async def get_dashboard_stats(db: AsyncSession = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+async def get_dashboard_stats(db: AsyncSession = Depends(database.get_db), current_user: auth.Principal = Depends(auth.get_current_active_principal)):
     # Existing minimal stats
     my_urls = (await db.execute(select(models.URL).where(models.URL.user_id == current_user.id).order_by(desc(models.URL.created_at)).limit(10))).scalars().all()
     total = (await db.execute(select(func.sum(models.URL.clicks)).where(models.URL.user_id == current_user.id))).scalar() or 0
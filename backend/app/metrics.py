@@ -0,0 +1,184 @@
+import bisect
+import contextvars
+import os
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+
+# Minimal Prometheus text-format metrics, kept in process. Each uvicorn worker
+# exposes its own numbers (scrape every worker, or let Prometheus sum them).
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # Bearer token for /metrics; unset disables the endpoint
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels=()):
+        self.name, self.doc, self.label_names = name, doc, tuple(labels)
+        self._values = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.label_names = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {} # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.label_names + ("le",)
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {series[-1]}"
+
+
+class Collected:
+    """Values read at scrape time from a callback returning {labels tuple: value}."""
+
+    def __init__(self, name: str, doc: str, labels=(), collect=None, kind: str = "gauge"):
+        self.name, self.doc, self.label_names = name, doc, tuple(labels)
+        self.collect = collect
+        self.kind = kind # "gauge", or "counter" for totals kept elsewhere
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Hot path metrics ---
+
+http_requests = register(Counter(
+    "shawty_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+))
+http_latency = register(Histogram(
+    "shawty_http_request_duration_seconds", "HTTP request latency by route", ("method", "route")
+))
+link_cache_lookups = register(Counter(
+    "shawty_link_cache_lookups_total", "Short code lookups by cache layer and result", ("layer", "result")
+))
+db_queries = register(Counter(
+    "shawty_db_queries_total", "SQL statements executed", ()
+))
+db_query_latency = register(Histogram(
+    "shawty_db_query_duration_seconds", "SQL statement latency", ()
+))
+db_queries_per_request = register(Histogram(
+    "shawty_db_queries_per_request", "SQL statements per HTTP request by route", ("route",), buckets=COUNT_BUCKETS
+))
+db_time_per_request = register(Histogram(
+    "shawty_db_time_per_request_seconds", "Time spent in SQL per HTTP request by route", ("route",)
+))
+enrichment_latency = register(Histogram(
+    "shawty_enrichment_lookup_duration_seconds", "GeoIP / user agent lookup latency", ("lookup",), buckets=FAST_BUCKETS
+))
+
+
+# --- Per-request DB accounting ---
+
+# [queries, seconds] for the current request; SQLAlchemy's greenlets share the context
+_request_db = contextvars.ContextVar("request_db", default=None)
+
+
+def start_request():
+    return _request_db.set([0, 0.0])
+
+
+def finish_request(token, route: str):
+    stats = _request_db.get()
+    _request_db.reset(token)
+    if stats is not None:
+        db_queries_per_request.observe(stats[0], route)
+        db_time_per_request.observe(stats[1], route)
+
+
+def instrument_engine(engine):
+    """Count and time every statement run through the engine."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        db_queries.inc()
+        db_query_latency.observe(elapsed)
+        stats = _request_db.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        starts = context.connection.info.get("query_start") if context.connection else None
+        if starts:
+            starts.pop()
+
+
+def collector(name: str, doc: str, labels=(), kind: str = "gauge"):
+    """Decorator registering a scrape-time callback."""
+    def decorator(collect):
+        register(Collected(name, doc, labels, collect, kind))
+        return collect
+    return decorator
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Date, Boolean, ForeignKey, Index, Sequence
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -17,6 +17,12 @@ class User(Base):
 
     urls = relationship("URL", back_populates="owner", cascade="all, delete-orphan")
 
+    # Keyset pagination for /admin/users (newest first)
+    __table_args__ = (Index("ix_users_created_id", created_at.desc(), id.desc()),)
+
+# Counter behind generated short codes (see shortcodes.py)
+short_code_seq = Sequence("short_code_seq", metadata=Base.metadata)
+
 class URL(Base):
     __tablename__ = "urls"
 
@@ -36,16 +42,78 @@ class URL(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     owner = relationship("User", back_populates="urls")
 
-    click_events = relationship("ClickEvent", back_populates="url", cascade="all, delete-orphan")
+    # passive_deletes: Postgres cascades to click_events, the ORM never loads them to delete
+    click_events = relationship("ClickEvent", back_populates="url", cascade="all, delete-orphan", passive_deletes=True)
+
+    # Keyset pagination for /urls (a user's links, newest first)
+    __table_args__ = (Index("ix_urls_user_created_id", user_id, created_at.desc(), id.desc()),)
 
 class ClickEvent(Base):
     __tablename__ = "click_events"
 
-    id = Column(Integer, primary_key=True, index=True)
-    url_id = Column(Integer, ForeignKey("urls.id"))
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    # Range-partitioned by month on timestamp (see partitions.py), so the
+    # partition key is part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    url_id = Column(Integer, ForeignKey("urls.id", ondelete="CASCADE"))
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    # Dictionary-encoded dimensions (ids into click_dimension_values, see dimensions.py).
+    # device_id / country_id stay NULL until the click is enriched.
+    referrer_id = Column(Integer, nullable=True)
+    device_id = Column(Integer, nullable=True)
+    country_id = Column(Integer, nullable=True)
+    # Plain-text dimensions, only set on clicks recorded before dictionary encoding
     referrer = Column(String, nullable=True)
     user_agent = Column(String, nullable=True)
     country = Column(String, nullable=True)
 
     url = relationship("URL", back_populates="click_events")
+
+    __table_args__ = (
+        Index("ix_click_events_url_timestamp", url_id, timestamp),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+class ClickDimensionValue(Base):
+    """Interned click dimension labels: referrer host, device label, country."""
+    __tablename__ = "click_dimension_values"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False) # referrer | device | country
+    value = Column(String, nullable=False)
+
+    __table_args__ = (Index("ix_click_dimension_values_kind_value", "kind", "value", unique=True),)
+
+# --- Click Rollups (pre-aggregated for /analytics/dashboard) ---
+# user_id is denormalized from urls so the dashboard never needs an IN (...) list.
+
+class ClickRollupHourly(Base):
+    __tablename__ = "click_rollup_hourly"
+
+    url_id = Column(Integer, ForeignKey("urls.id", ondelete="CASCADE"), primary_key=True)
+    bucket = Column(DateTime, primary_key=True) # Start of the hour (UTC)
+    user_id = Column(Integer, nullable=True)
+    clicks = Column(Integer, default=0)
+
+    __table_args__ = (Index("ix_click_rollup_hourly_user_bucket", "user_id", "bucket"),)
+
+class ClickRollupDaily(Base):
+    __tablename__ = "click_rollup_daily"
+
+    url_id = Column(Integer, ForeignKey("urls.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, nullable=True)
+    clicks = Column(Integer, default=0)
+
+    __table_args__ = (Index("ix_click_rollup_daily_user_day", "user_id", "day"),)
+
+class ClickRollupDimension(Base):
+    __tablename__ = "click_rollup_dimension"
+
+    url_id = Column(Integer, ForeignKey("urls.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    dimension = Column(String, primary_key=True) # referrer | device | country
+    value = Column(String, primary_key=True)
+    user_id = Column(Integer, nullable=True)
+    clicks = Column(Integer, default=0)
+
+    __table_args__ = (Index("ix_click_rollup_dimension_user", "user_id", "dimension", "day"),)
@@ -0,0 +1,38 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import desc, tuple_
+
+# Keyset pagination on (created_at, id), newest first. The cursor is an opaque
+# token for the last row of the previous page; the next one is returned in the
+# X-Next-Cursor response header.
+CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset(stmt, created_col, id_col, cursor: str, limit: int):
+    """Order newest first and start after the cursor row (if any)."""
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(created_col, id_col) < tuple_(created_at, row_id))
+    return stmt.order_by(desc(created_col), desc(id_col)).limit(limit)
+
+
+def set_next_cursor(response, rows, limit: int):
+    if rows and len(rows) == limit:
+        response.headers[CURSOR_HEADER] = encode_cursor(rows[-1].created_at, rows[-1].id)
@@ -0,0 +1,209 @@
+import asyncio
+import gzip
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+from . import models, database
+
+# click_events is range-partitioned by month (click_events_y2025m01, ...):
+#   - Partitions are created PARTITION_PREMAKE_MONTHS ahead of time.
+#   - With CLICK_RETENTION_MONTHS set, partitions entirely older than that are
+#     written to CLICK_ARCHIVE_DIR as gzipped CSV, then detached and dropped.
+#     The dashboards read the rollups, which are kept.
+#   - A table from before partitioning is attached as a single partition
+#     (click_events_legacy) covering everything up to the end of that month.
+CLICK_RETENTION_MONTHS = int(os.getenv("CLICK_RETENTION_MONTHS", 0)) # 0 keeps everything
+CLICK_ARCHIVE_DIR = os.getenv("CLICK_ARCHIVE_DIR", "archive") # Empty: drop without archiving
+PARTITION_PREMAKE_MONTHS = int(os.getenv("PARTITION_PREMAKE_MONTHS", 2))
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 6 * 3600))
+
+TABLE = models.ClickEvent.__tablename__
+LEGACY = f"{TABLE}_legacy"
+LOCK_ID = 0x636C6963 # Advisory lock: one worker converts / maintains at a time
+
+_BOUND = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def month_start(dt) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt: datetime, months: int) -> datetime:
+    year, month = divmod(dt.month - 1 + months, 12)
+    return datetime(dt.year + year, month + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"{TABLE}_y{start.year}m{start.month:02d}"
+
+
+def _parse_bound(value: str):
+    if value == "MINVALUE":
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+async def list_partitions(conn):
+    """[(name, lower, upper)] by lower bound; lower is None for the legacy partition."""
+    res = await conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)"
+    ), {"table": TABLE})
+    partitions = []
+    for name, bound in res.all():
+        match = _BOUND.search(bound or "")
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda p: p[1] or datetime.min)
+
+
+async def _is_partitioned(conn) -> bool:
+    res = await conn.execute(
+        text("SELECT relkind::text FROM pg_class WHERE oid = to_regclass(:table)"), {"table": TABLE}
+    )
+    return res.scalar() == "p"
+
+
+async def _convert_legacy(conn):
+    """Turn a plain click_events table into the first partition of a partitioned one."""
+    print("Partitioning click_events (one-off)...")
+    max_id, latest = (await conn.execute(text(f'SELECT max(id), max("timestamp") FROM {TABLE}'))).one()
+    old_seq = (await conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": TABLE})).scalar()
+
+    for stmt in (
+        f"ALTER TABLE {TABLE} RENAME TO {LEGACY}",
+        # Names the new parent will use; its own (id, timestamp) key is built on attach
+        f"ALTER TABLE {LEGACY} DROP CONSTRAINT IF EXISTS {TABLE}_pkey",
+        f"ALTER TABLE {LEGACY} DROP CONSTRAINT IF EXISTS {TABLE}_url_id_fkey",
+        f"DROP INDEX IF EXISTS ix_{TABLE}_id",
+        f'UPDATE {LEGACY} SET "timestamp" = \'epoch\' WHERE "timestamp" IS NULL',
+        f'ALTER TABLE {LEGACY} ALTER COLUMN "timestamp" SET NOT NULL',
+        f"ALTER TABLE {LEGACY} ALTER COLUMN id DROP DEFAULT",
+    ):
+        await conn.execute(text(stmt))
+    if old_seq:
+        await conn.execute(text(f"DROP SEQUENCE {old_seq}"))
+
+    await conn.run_sync(models.ClickEvent.__table__.create)
+    if max_id:
+        # New ids carry on where the old table stopped
+        await conn.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :value)"), {"table": TABLE, "value": max_id})
+
+    upper = add_months(month_start(max(latest or datetime.utcnow(), datetime.utcnow())), 1)
+    await conn.execute(text(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY} FOR VALUES FROM (MINVALUE) TO ('{upper}')"
+    ))
+    print(f"click_events partitioned, existing rows kept in {LEGACY} (until {upper:%Y-%m})")
+
+
+async def ensure_partitions(conn, now: datetime = None):
+    """Create monthly partitions from the current month to PARTITION_PREMAKE_MONTHS ahead."""
+    start = month_start(now or datetime.utcnow())
+    covered_until = max((upper for _, _, upper in await list_partitions(conn)), default=None)
+    for i in range(PARTITION_PREMAKE_MONTHS + 1):
+        lower = add_months(start, i)
+        if covered_until and lower < covered_until:
+            continue
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(lower)} PARTITION OF {TABLE} "
+            f"FOR VALUES FROM ('{lower}') TO ('{add_months(lower, 1)}')"
+        ))
+
+
+async def _add_missing_columns(conn):
+    """create_all never alters existing tables: add new nullable click_events columns."""
+    res = await conn.execute(
+        text("SELECT column_name FROM information_schema.columns WHERE table_name = :table"), {"table": TABLE}
+    )
+    existing = set(res.scalars().all())
+    for col in models.ClickEvent.__table__.columns:
+        if col.name not in existing and col.nullable:
+            await conn.execute(text(
+                f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS {col.name} {col.type.compile(dialect=conn.dialect)}"
+            ))
+
+
+async def lock(conn):
+    """Serialize startup schema changes across workers until the transaction ends."""
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": LOCK_ID})
+
+
+async def setup(conn):
+    """Startup (inside the create_all transaction): partition click_events and add partitions."""
+    await lock(conn)
+    # Before converting, so the old table matches the new parent's columns
+    await _add_missing_columns(conn)
+    if not await _is_partitioned(conn):
+        await _convert_legacy(conn)
+    await ensure_partitions(conn)
+
+
+async def archive_partition(conn, name: str) -> str:
+    """COPY a partition to CLICK_ARCHIVE_DIR/<name>.csv.gz and return the path."""
+    os.makedirs(CLICK_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(CLICK_ARCHIVE_DIR, f"{name}.csv.gz")
+    tmp_path = f"{path}.tmp"
+    raw = await conn.get_raw_connection()
+    try:
+        with gzip.open(tmp_path, "wb") as f:
+            async def write(chunk):
+                await asyncio.to_thread(f.write, chunk)
+            await raw.driver_connection.copy_from_table(name, output=write, format="csv", header=True)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return path
+
+
+async def apply_retention(conn, now: datetime = None) -> list:
+    """Archive and drop partitions older than CLICK_RETENTION_MONTHS. Returns their names."""
+    if CLICK_RETENTION_MONTHS <= 0:
+        return []
+    cutoff = add_months(month_start(now or datetime.utcnow()), -CLICK_RETENTION_MONTHS)
+    dropped = []
+    for name, _, upper in await list_partitions(conn):
+        if upper > cutoff:
+            continue
+        if CLICK_ARCHIVE_DIR:
+            path = await archive_partition(conn, name)
+            print(f"Archived {name} to {path}")
+        # Dropping a whole partition instead of DELETE ... WHERE timestamp < cutoff
+        await conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+        await conn.execute(text(f"DROP TABLE {name}"))
+        await conn.commit()
+        dropped.append(name)
+        print(f"Dropped click partition {name} (retention {CLICK_RETENTION_MONTHS} months)")
+    return dropped
+
+
+async def maintain():
+    """Premake partitions and apply retention, in one worker at a time."""
+    async with database.engine.connect() as conn:
+        if not (await conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": LOCK_ID})).scalar():
+            return
+        try:
+            await ensure_partitions(conn)
+            await conn.commit()
+            await apply_retention(conn)
+        finally:
+            # Session-level lock: release it before the connection goes back to the pool
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": LOCK_ID})
+            await conn.commit()
+
+
+async def run_maintenance():
+    """Background task."""
+    while True:
+        try:
+            await maintain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Click partition maintenance failed: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
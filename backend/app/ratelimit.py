@@ -0,0 +1,162 @@
+import ipaddress
+import os
+import secrets
+import time
+from collections import OrderedDict, deque
+
+from fastapi import Depends, HTTPException, Request, status
+
+from . import auth
+
+# Sliding-window-log rate limiting. Each decision is a single Redis round trip
+# (one Lua script); if Redis is unavailable the worker falls back to an
+# in-process window, so limits still hold per worker.
+redis_client = None # Set by main.startup_event
+
+# Trim the log, count it, and record this request if it is under the limit.
+# Returns {allowed, remaining_or_retry_after_ms}.
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if count >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return {0, tonumber(oldest[2]) + window - now}
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window)
+return {1, limit - count - 1}
+"""
+
+
+class Policy:
+    def __init__(self, name: str, limit: int, window: int, key: str = "ip", detail: str = "Rate limit exceeded"):
+        # Overridable per policy, e.g. RATE_LIMIT_SHORTEN=5/2592000 (requests/seconds)
+        override = os.getenv(f"RATE_LIMIT_{name.upper()}")
+        if override:
+            limit, window = (int(part) for part in override.split("/"))
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.key = key # "ip" or "user"
+        self.detail = detail
+
+
+POLICIES = {
+    p.name: p for p in (
+        Policy("shorten", 5, 30 * 86400, detail="Rate limit exceeded. Please Sign Up for unlimited links."),
+        Policy("bulk", 60, 3600, key="user"),
+        Policy("unlock", 10, 60, detail="Too many attempts, please wait a moment"),
+        Policy("check", 120, 60),
+        Policy("token", 10, 60, detail="Too many login attempts, please wait a moment"),
+    )
+}
+
+
+# Proxies whose X-Forwarded-For we believe when keying limits, e.g. "172.16.0.0/12"
+# for nginx on the compose network. Empty: limits use the peer address only.
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.getenv("TRUSTED_PROXIES", "").split(",") if net.strip()
+]
+
+
+def _is_trusted(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in net for net in TRUSTED_PROXIES)
+
+
+def rate_limit_ip(request: Request) -> str:
+    """
+    Address to key IP limits on. Client-supplied headers are ignored unless the
+    peer is a trusted proxy; then X-Forwarded-For is read right to left (each
+    proxy appends) up to the first hop that is not a trusted proxy.
+    """
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted(peer):
+        return peer
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+# Helper to extract real client IP behind proxy (analytics only: spoofable, never use for limits)
+def get_client_ip(request: Request) -> str:
+    x_forwarded_for = request.headers.get("x-forwarded-for")
+    if x_forwarded_for:
+        # X-Forwarded-For can be a comma-separated list, first one is the client
+        return x_forwarded_for.split(",")[0].strip()
+    return request.headers.get("x-real-ip") or request.client.host
+
+
+class LocalWindow:
+    """In-process sliding window log, used while Redis is unreachable."""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._logs = OrderedDict()
+
+    def hit(self, key: str, now_ms: int, window_ms: int, limit: int):
+        log = self._logs.get(key)
+        if log is None:
+            log = self._logs[key] = deque()
+            while len(self._logs) > self.max_keys:
+                self._logs.popitem(last=False)
+        self._logs.move_to_end(key)
+        while log and log[0] <= now_ms - window_ms:
+            log.popleft()
+        if len(log) >= limit:
+            return False, log[0] + window_ms - now_ms
+        log.append(now_ms)
+        return True, limit - len(log)
+
+
+local_window = LocalWindow()
+
+
+async def hit(policy: Policy, identity: str):
+    """Record one request. Returns (allowed, remaining or retry-after in ms)."""
+    key = f"rl:{policy.name}:{identity}"
+    now_ms = int(time.time() * 1000)
+    window_ms = policy.window * 1000
+    if redis_client:
+        try:
+            script = redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+            allowed, value = await script(
+                keys=[key], args=[now_ms, window_ms, policy.limit, f"{now_ms}-{secrets.token_hex(4)}"]
+            )
+            return bool(allowed), int(value)
+        except Exception as e:
+            print(f"Rate limiter falling back to local window: {e}")
+    return local_window.hit(key, now_ms, window_ms, policy.limit)
+
+
+async def enforce(policy: Policy, identity: str):
+    allowed, value = await hit(policy, identity)
+    if not allowed:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=policy.detail,
+            headers={"Retry-After": str(max(1, -(-value // 1000)))},
+        )
+
+
+def limit(name: str):
+    """Route dependency enforcing the named policy, e.g. Depends(ratelimit.limit("unlock"))."""
+    policy = POLICIES[name]
+
+    if policy.key == "user":
+        async def dependency(principal: auth.Principal = Depends(auth.get_current_principal)):
+            await enforce(policy, f"user:{principal.id}")
+    else:
+        async def dependency(request: Request):
+            await enforce(policy, f"ip:{rate_limit_ip(request)}")
+
+    return dependency
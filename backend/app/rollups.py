@@ -0,0 +1,114 @@
+from collections import Counter
+
+from sqlalchemy import Date, cast, func, literal, or_, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from . import models
+
+# Incrementally maintained click rollups. The click flusher feeds hourly, daily
+# and referrer counts; enrichment feeds device and country once they are known.
+
+Hourly = models.ClickRollupHourly.__table__
+Daily = models.ClickRollupDaily.__table__
+Dimension = models.ClickRollupDimension.__table__
+
+BACKFILL_LOCK_ID = 0x726F6C6C # Advisory lock: workers starting together backfill once
+
+
+def _upsert(table, keys, counts: Counter, owners: dict):
+    rows = []
+    for key, clicks in counts.items():
+        row = dict(zip(keys, key))
+        row["user_id"] = owners.get(row["url_id"])
+        row["clicks"] = clicks
+        rows.append(row)
+    stmt = pg_insert(table).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={"clicks": table.c.clicks + stmt.excluded.clicks},
+    )
+
+
+async def add_clicks(db, rows, owners: dict):
+    """Count a batch of click_events rows into the hourly, daily and referrer rollups."""
+    hourly, daily, referrers = Counter(), Counter(), Counter()
+    for row in rows:
+        ts = row["timestamp"]
+        hourly[(row["url_id"], ts.replace(minute=0, second=0, microsecond=0))] += 1
+        daily[(row["url_id"], ts.date())] += 1
+        referrers[(row["url_id"], ts.date(), "referrer", row["referrer"] or "")] += 1
+
+    if not hourly:
+        return
+    await db.execute(_upsert(Hourly, ("url_id", "bucket"), hourly, owners))
+    await db.execute(_upsert(Daily, ("url_id", "day"), daily, owners))
+    await db.execute(_upsert(Dimension, ("url_id", "day", "dimension", "value"), referrers, owners))
+
+
+async def add_dimensions(db, counts: Counter, owners: dict):
+    """counts: {(url_id, day, dimension, value): clicks} for device/country."""
+    if counts:
+        await db.execute(_upsert(Dimension, ("url_id", "day", "dimension", "value"), counts, owners))
+
+
+async def backfill(db):
+    """Build the rollups from raw click_events once, if they are still empty.
+
+    Must finish before this worker flushes any clicks: those would make the
+    rollups non-empty, and ON CONFLICT DO NOTHING would drop the older clicks.
+    """
+    # Held until commit; the other workers wait here, then find the rollups filled
+    await db.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": BACKFILL_LOCK_ID})
+    if (await db.execute(select(Daily.c.url_id).limit(1))).first() is not None:
+        return
+    if (await db.execute(select(models.ClickEvent.id).limit(1))).first() is None:
+        return
+
+    print("Backfilling click rollups from click_events...")
+    ce = models.ClickEvent
+    day = cast(ce.timestamp, Date)
+    hour = func.date_trunc("hour", ce.timestamp)
+    joined = select().select_from(ce).join(models.URL, models.URL.id == ce.url_id)
+
+    await db.execute(
+        pg_insert(Hourly).from_select(
+            ["url_id", "bucket", "user_id", "clicks"],
+            joined.add_columns(ce.url_id, hour, models.URL.user_id, func.count())
+            .group_by(ce.url_id, hour, models.URL.user_id),
+        ).on_conflict_do_nothing()
+    )
+    await db.execute(
+        pg_insert(Daily).from_select(
+            ["url_id", "day", "user_id", "clicks"],
+            joined.add_columns(ce.url_id, day, models.URL.user_id, func.count())
+            .group_by(ce.url_id, day, models.URL.user_id),
+        ).on_conflict_do_nothing()
+    )
+    # Group on the integer dictionary ids first, then join the labels back.
+    # Clicks from before dictionary encoding carry the label itself instead.
+    labels = models.ClickDimensionValue.__table__
+    for dimension, id_col, text_col in (
+        ("referrer", ce.referrer_id, ce.referrer),
+        ("device", ce.device_id, ce.user_agent),
+        ("country", ce.country_id, ce.country),
+    ):
+        q = joined.add_columns(
+            ce.url_id, day.label("day"), id_col.label("dim_id"), text_col.label("text"),
+            models.URL.user_id, func.count().label("clicks"),
+        )
+        if dimension != "referrer":
+            # Enrichment adds these itself once the click is processed
+            q = q.where(or_(ce.country_id.is_not(None), ce.country != "Processing..."))
+        by_id = q.group_by(ce.url_id, day, id_col, text_col, models.URL.user_id).subquery()
+
+        value = func.coalesce(labels.c.value, by_id.c.text, "")
+        await db.execute(
+            pg_insert(Dimension).from_select(
+                ["url_id", "day", "dimension", "value", "user_id", "clicks"],
+                select(by_id.c.url_id, by_id.c.day, literal(dimension), value, by_id.c.user_id, func.sum(by_id.c.clicks))
+                .select_from(by_id)
+                .outerjoin(labels, labels.c.id == by_id.c.dim_id)
+                .group_by(by_id.c.url_id, by_id.c.day, value, by_id.c.user_id),
+            ).on_conflict_do_nothing()
+        )
+    await db.commit()
@@ -85,6 +85,19 @@ class URL(URLBase):
     class Config:
         from_attributes = True
 
+class BulkShortenResult(BaseModel):
+    index: int
+    url: Optional[URL] = None
+    error: Optional[str] = None
+
+class SlugCheckRequest(BaseModel):
+    slugs: List[str]
+
+class SlugAvailability(BaseModel):
+    slug: str
+    available: bool
+    reason: Optional[str] = None
+
 # --- Analytics Schemas ---
 class ClickEvent(BaseModel):
     id: int
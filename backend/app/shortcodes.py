@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import os
+import string
+
+from sqlalchemy import func, select
+
+from . import models
+
+# Short-code allocation without existence checks:
+#   1. Each worker leases a block of unique counter values from a Postgres sequence.
+#   2. Each counter is scrambled with a keyed Feistel permutation over 62^6, so
+#      codes look random but two counters can never map to the same code.
+#   3. The counter is base62-encoded into a 6 char code.
+ALPHABET = string.ascii_letters + string.digits
+CODE_LENGTH = 6
+DOMAIN = len(ALPHABET) ** CODE_LENGTH # 62^6 ~= 5.7e10 codes
+
+SHORTCODE_BLOCK_SIZE = int(os.getenv("SHORTCODE_BLOCK_SIZE", 100))
+SHORTCODE_SECRET = os.getenv("SHORTCODE_SECRET") or os.getenv("SECRET_KEY") or "shawtylink"
+
+# Balanced Feistel network on 36 bits (2^36 > 62^6), cycle-walking back into DOMAIN
+_HALF_BITS = 18
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_ROUNDS = 4
+_KEY = hashlib.sha256(SHORTCODE_SECRET.encode("utf-8")).digest()
+
+
+def _round(value: int, i: int) -> int:
+    digest = hashlib.blake2b(value.to_bytes(4, "big"), key=_KEY, digest_size=4, salt=bytes([i]) * 16).digest()
+    return int.from_bytes(digest, "big") & _HALF_MASK
+
+
+def _feistel(value: int) -> int:
+    left, right = value >> _HALF_BITS, value & _HALF_MASK
+    for i in range(_ROUNDS):
+        left, right = right, left ^ _round(right, i)
+    return (left << _HALF_BITS) | right
+
+
+def permute(counter: int) -> int:
+    """Bijection on [0, DOMAIN)."""
+    value = _feistel(counter)
+    while value >= DOMAIN:
+        value = _feistel(value)
+    return value
+
+
+def encode(number: int) -> str:
+    chars = []
+    for _ in range(CODE_LENGTH):
+        number, rem = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[rem])
+    return "".join(reversed(chars))
+
+
+def code_for(counter: int) -> str:
+    return encode(permute(counter % DOMAIN))
+
+
+class ShortCodeAllocator:
+    """Hands out codes from per-worker blocks leased from short_code_seq."""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._pool = []
+        self._lock = None
+
+    async def _lease(self, db, count: int):
+        # Sequence values are unique even when several workers lease at once
+        res = await db.execute(
+            select(models.short_code_seq.next_value()).select_from(func.generate_series(1, count))
+        )
+        self._pool.extend(res.scalars().all())
+
+    async def allocate_many(self, db, count: int) -> list:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if len(self._pool) < count:
+                await self._lease(db, max(self.block_size, count - len(self._pool)))
+            counters, self._pool = self._pool[:count], self._pool[count:]
+        return [code_for(c) for c in counters]
+
+    async def allocate(self, db) -> str:
+        return (await self.allocate_many(db, 1))[0]
+
+
+allocator = ShortCodeAllocator(SHORTCODE_BLOCK_SIZE)
@@ -0,0 +1,65 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, nulls_last, or_, select
+
+from . import models, database, cache
+
+# Startup warm-up: after a deploy or a Redis flush, preload the hottest links
+# into Redis (and this worker's L1) so the first minutes of traffic don't all
+# fall through to Postgres. One worker does the work; the others read Redis.
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", 10000)) # 0 disables warm-up
+WARMUP_BUDGET = float(os.getenv("WARMUP_BUDGET", 30)) # seconds
+WARMUP_RECENT_DAYS = int(os.getenv("WARMUP_RECENT_DAYS", 7))
+WARMUP_CHUNK = 1000
+LOCK_KEY = "warmup:links"
+
+
+def hottest_links(limit: int):
+    """Active, unexpired links by recent clicks (daily rollups), then all-time clicks."""
+    since = datetime.utcnow().date() - timedelta(days=WARMUP_RECENT_DAYS)
+    recent = (
+        select(models.ClickRollupDaily.url_id, func.sum(models.ClickRollupDaily.clicks).label("clicks"))
+        .where(models.ClickRollupDaily.day >= since)
+        .group_by(models.ClickRollupDaily.url_id)
+        .subquery()
+    )
+    return (
+        select(models.URL)
+        .outerjoin(recent, recent.c.url_id == models.URL.id)
+        .where(
+            models.URL.is_active == True,
+            or_(models.URL.expires_at.is_(None), models.URL.expires_at > datetime.utcnow()),
+        )
+        .order_by(nulls_last(recent.c.clicks.desc()), models.URL.clicks.desc())
+        .limit(limit)
+    )
+
+
+async def warm(redis_client, top_n: int = WARMUP_TOP_N, budget: float = WARMUP_BUDGET, force: bool = False) -> int:
+    """Cache up to top_n links, stopping after `budget` seconds. Returns links cached."""
+    if not redis_client or top_n <= 0:
+        return 0
+    start = time.monotonic()
+    total = 0
+    try:
+        # Held (not released) for a minute or the budget, so workers starting together warm up once
+        if not await redis_client.set(LOCK_KEY, 1, nx=not force, ex=max(60, int(budget))):
+            return 0 # Another worker is warming up / just did
+        async with database.AsyncSessionLocal() as db:
+            result = await db.stream(hottest_links(top_n).execution_options(yield_per=WARMUP_CHUNK))
+            async for rows in result.scalars().partitions():
+                # One pipeline per chunk
+                await cache.store_links(redis_client, [
+                    (row.short_code, cache.link_record(row), row.clicks or 0) for row in rows
+                ])
+                total += len(rows)
+                elapsed = time.monotonic() - start
+                print(f"Cache warm-up: {total}/{top_n} links in {elapsed:.1f}s")
+                if elapsed > budget:
+                    print(f"Cache warm-up stopped at its {budget:.0f}s budget")
+                    break
+    except Exception as e:
+        print(f"Cache warm-up failed after {total} links: {e}")
+    return total
@@ -163,6 +163,9 @@ export default function Analytics() {
                                 fontSize={12}
                                 tickFormatter={(str) => {
                                     const date = new Date(str)
+                                    if (timeRange === '24h') {
+                                        return `${String(date.getHours()).padStart(2, '0')}:00`
+                                    }
                                     return `${date.getDate()}/${date.getMonth() + 1}`
                                 }}
                             />